@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import argparse
+import logging.config
+from collections import defaultdict
+
+import osmium
+import mercantile
+import psycopg2
+import psycopg2.extras
+
+import configuration
+
+
+class ChangeHandler(osmium.SimpleHandler):
+    """
+    Counts changed nodes and ways in each map area, way location is determined by its nodes present in the
+    same change file so ways changed only in tags are not accounted
+    """
+    def __init__(self, logger):
+        super().__init__()
+        self.logger = logger
+        self.changes = defaultdict(int)
+        self.unlocated = 0
+
+    def add(self, west, south, east, north):
+        # clamp to mercator limits as mercantile does not accept poles
+        south = max(south, -85.0511)
+        north = min(north, 85.0511)
+        for tile in mercantile.tiles(west, south, east, north, 7):
+            self.changes['{}-{}'.format(tile.x, tile.y)] += 1
+
+    def node(self, n):
+        if n.location.valid():
+            self.add(n.location.lon, n.location.lat, n.location.lon, n.location.lat)
+        else:
+            self.unlocated += 1
+
+    def way(self, w):
+        west = south = 180
+        east = north = -180
+        located = False
+        for node in w.nodes:
+            if node.location.valid():
+                west = min(west, node.location.lon)
+                south = min(south, node.location.lat)
+                east = max(east, node.location.lon)
+                north = max(north, node.location.lat)
+                located = True
+        if located:
+            self.add(west, south, east, north)
+        else:
+            self.unlocated += 1
+
+
+def change_files(path):
+    """
+    returns change files in replication sequence order
+    """
+    files = glob.glob(os.path.join(path, '**', '*.osc'), recursive=True)
+    files += glob.glob(os.path.join(path, '**', '*.osc.gz'), recursive=True)
+    return sorted(files)
+
+
+def process_changes(path, logger, keep=False):
+    marker_path = os.path.join(path, 'processed')
+    last = None
+    if os.path.exists(marker_path):
+        with open(marker_path) as f:
+            last = f.read().strip()
+    handler = ChangeHandler(logger)
+    processed = None
+    for filename in change_files(path):
+        name = os.path.relpath(filename, path)
+        if last and name <= last:
+            continue
+        logger.info("Processing %s" % filename)
+        handler.apply_file(filename, locations=True)
+        processed = name
+    if processed is None:
+        logger.info("No new change files")
+        return
+    logger.info("Changed {:,} areas, {:,} objects without location".format(len(handler.changes), handler.unlocated))
+
+    with psycopg2.connect(configuration.STATS_DB_DSN) as c:
+        with c.cursor() as cur:
+            psycopg2.extras.execute_values(
+                cur, "INSERT INTO map_changes (area, changes) VALUES %s ON CONFLICT (area) "
+                     "DO UPDATE SET changes = map_changes.changes + EXCLUDED.changes",
+                list(handler.changes.items()))
+        c.commit()
+
+    if not keep:
+        with open(marker_path, 'w') as f:
+            f.write(processed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='MapTrek map change tracker')
+    parser.add_argument('-p', '--changes-path', default=configuration.CHANGES_PATH, help='path to replication change files')
+    parser.add_argument('-k', '--keep', action='store_true', help='do not mark change files as processed')
+    parser.add_argument('-l', '--log', default='ERROR', help='set logging verbosity')
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.log.upper(), None)
+    if not isinstance(log_level, int):
+        print("Invalid log level: %s" % args.log)
+        exit(1)
+
+    logging.basicConfig(level=log_level, format='%(asctime)s %(levelname)s - %(message)s', datefmt='%H:%M:%S')
+    logger = logging.getLogger(__name__)
+
+    try:
+        process_changes(args.changes_path, logger, args.keep)
+    except Exception as e:
+        logger.exception("An error occurred")
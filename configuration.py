@@ -11,6 +11,19 @@ DATA_PATH = '/gis/data'
 DATA_DB_DSN = 'dbname=gis'
 FILTERS_PATH = '/gis/mapcreator/filters'
 FROM_FILE = False
+# store identical tiles once (tiles table becomes a view)
+DEDUP_TILES = False
+# reuse tiles of previously created map which input has not changed
+INCREMENTAL = False
+# read database elements with binary COPY instead of cursor
+BINARY_COPY = False
+# maximum number of worker processes of one map (0 - all available processors)
+MAX_WORKERS = 0
+# prioritize areas by changes from replication files (see changes.py)
+TRACK_CHANGES = False
+CHANGES_PATH = '/gis/data/changes'
+# store map creation profile in stats database (existing databases need setup/upgrade.sql)
+STORE_PROFILE = False
 
 MAP_DOWNLOAD_LOG = '/var/log/nginx/maps.log'
 STATS_DB_DSN = 'dbname=gis'
@@ -0,0 +1,166 @@
+"""
+A WKB geometry encoder that processes coordinate sequences with NumPy.
+
+Produces exactly the same output as GeomEncoder: coordinates are rounded, flipped, delta encoded
+and consecutive duplicates are dropped, but it is done for the whole line or ring at once instead
+of point by point.
+"""
+
+import struct
+
+import numpy
+
+from .GeomEncoder import ExceptionWKBParser
+
+
+# shorter sequences are processed without NumPy as array setup costs more then it saves
+ARRAY_MIN_POINTS = 32
+
+_POINT, _LINESTRING, _POLYGON, _MULTIPOINT, _MULTILINESTRING, _MULTIPOLYGON, _GEOMETRYCOLLECTION = range(1, 8)
+
+
+class ArrayGeomEncoder:
+
+    def __init__(self, tileSize):
+        self.coordinates = []
+        self.index = []
+        self.lastX = 0
+        self.lastY = 0
+        self.dropped = 0
+        self.num_points = 0
+        self.isPoint = True
+        self.isPoly = False
+        self.tileSize = tileSize - 1
+        self.first = True
+        self._buf = None
+        self._pos = 0
+        self._endflag = '>'
+
+    def parseGeometry(self, geometry):
+        self.coordinates = []
+        self.index = []
+        self.lastX = 0
+        self.lastY = 0
+        self.isPoly = False
+        self.isPoint = True
+        self.dropped = 0
+        self.first = True
+        self._buf = geometry
+        self._pos = 0
+
+        self._dispatchNextType()
+
+        self._buf = None
+
+    def _unpack_uint32(self):
+        value = struct.unpack_from('%si' % self._endflag, self._buf, self._pos)[0]
+        self._pos += 4
+        return value
+
+    def _dispatchNextType(self):
+        endianness = self._buf[self._pos]
+        self._pos += 1
+        if endianness == 0:
+            self._endflag = '>'
+        elif endianness == 1:
+            self._endflag = '<'
+        else:
+            raise ExceptionWKBParser("Invalid endianness in WKB format.")
+
+        geotype = self._unpack_uint32()
+        # ignore srid
+        if geotype & 0x20000000:
+            self._pos += 4
+        dimensions = 3 if geotype & 0x80000000 else 2
+        geotype = geotype & 0x1FFFFFFF
+
+        if geotype == _POINT:
+            self._parsePoints(1, dimensions)
+        elif geotype == _LINESTRING:
+            self.isPoint = False
+            num_points = self._unpack_uint32()
+            self.num_points = 0
+            self._parsePoints(num_points, dimensions)
+            self.index.append(self.num_points)
+            self.first = True
+        elif geotype == _POLYGON:
+            self.isPoint = False
+            num_rings = self._unpack_uint32()
+            for _ in range(num_rings):
+                num_points = self._unpack_uint32()
+                self.num_points = 0
+                # skip the last point
+                self._parsePoints(num_points - 1, dimensions)
+                self._pos += 8 * dimensions
+                self.index.append(self.num_points)
+                self.first = True
+            self.isPoly = True
+        elif geotype == _MULTIPOLYGON:
+            num_polygons = self._unpack_uint32()
+            for n in range(num_polygons):
+                if n > 0:
+                    self.index.append(0)
+                self._dispatchNextType()
+        elif geotype in (_MULTIPOINT, _MULTILINESTRING, _GEOMETRYCOLLECTION):
+            num_geoms = self._unpack_uint32()
+            for _ in range(num_geoms):
+                self._dispatchNextType()
+        else:
+            raise ExceptionWKBParser('Error type to dispatch with geotype = %s' % str(geotype))
+
+    def _parsePoints(self, count, dimensions):
+        if count <= 0:
+            return
+        if count < ARRAY_MIN_POINTS:
+            self._parseFewPoints(count, dimensions)
+            return
+        data = numpy.frombuffer(self._buf, dtype='%sf8' % self._endflag, count=count * dimensions, offset=self._pos)
+        self._pos += 8 * count * dimensions
+        data = data.reshape(count, dimensions)[:, :2]
+        if not numpy.isfinite(data).all():
+            raise ValueError("cannot convert non-finite coordinate to integer")
+        # numpy rounds half to even exactly as python round() does
+        xx = numpy.rint(data[:, 0]).astype(numpy.int64)
+        # flip upside down
+        yy = self.tileSize - numpy.rint(data[:, 1]).astype(numpy.int64)
+
+        dx = numpy.diff(xx, prepend=self.lastX)
+        dy = numpy.diff(yy, prepend=self.lastY)
+        keep = (dx != 0) | (dy != 0)
+        if self.first:
+            keep[0] = True
+        kept = int(numpy.count_nonzero(keep))
+        deltas = numpy.empty(kept * 2, dtype=numpy.int64)
+        deltas[0::2] = dx[keep]
+        deltas[1::2] = dy[keep]
+        self.coordinates.extend(deltas.tolist())
+        self.num_points += kept
+        self.dropped += count - kept
+
+        self.first = False
+        self.lastX = int(xx[-1])
+        self.lastY = int(yy[-1])
+
+    def _parseFewPoints(self, count, dimensions):
+        data = struct.unpack_from('%s%dd' % (self._endflag, count * dimensions), self._buf, self._pos)
+        self._pos += 8 * count * dimensions
+        coordinates = self.coordinates
+        lastX = self.lastX
+        lastY = self.lastY
+        first = self.first
+        for i in range(0, count * dimensions, dimensions):
+            xx = int(round(data[i]))
+            # flip upside down
+            yy = self.tileSize - int(round(data[i + 1]))
+            if first or xx != lastX or yy != lastY:
+                coordinates.append(xx - lastX)
+                coordinates.append(yy - lastY)
+                self.num_points += 1
+            else:
+                self.dropped += 1
+            first = False
+            lastX = xx
+            lastY = yy
+        self.first = False
+        self.lastX = lastX
+        self.lastY = lastY
@@ -4,7 +4,7 @@ from util.core import Element
 
 from . import TileData_pb2
 
-from . import GeomEncoder
+from . import ArrayGeomEncoder
 from . import StaticVals
 from . import StaticKeys
 
@@ -29,7 +29,7 @@ class VectorTile:
     """
     """
     def __init__(self, extents, mappings):
-        self.geomencoder = GeomEncoder.GeomEncoder(extents)
+        self.geomencoder = ArrayGeomEncoder.ArrayGeomEncoder(extents)
         self.mappings = mappings
 
         # TODO count to sort by number of occurrences
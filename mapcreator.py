@@ -2,18 +2,33 @@
 
 import os
 import sys
+import json
 import time
+import fcntl
 import argparse
 import subprocess
+import multiprocessing
 import logging.config
 from datetime import timedelta
 
+import psutil
 import psycopg2
+import setproctitle
 
 import mapwrite
 import configuration
 
 
+# generation time of an area worth one tile worker, seconds
+WORKER_COST = 600
+# areas with unknown cost are assumed to be average
+DEFAULT_WORKERS = 2
+# memory reserved for each worker of an area until it is actually allocated
+WORKER_MEMORY = 1 << 30
+# area skipped in favor of lighter ones for this long is started next, seconds
+STARVATION_TIME = 1800
+
+
 class MapCreator:
 
     def __init__(self, data_dir, dry_run=False, forbid_interactive=False):
@@ -24,58 +39,71 @@ class MapCreator:
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
 
-        self.mapWriter = mapwrite.MapWriter(self.data_dir, self.dry_run, self.forbid_interactive)
+        self.mapWriter = mapwrite.MapWriter(self.data_dir, self.dry_run, self.forbid_interactive, dedup=configuration.DEDUP_TILES,
+                                            incremental=configuration.INCREMENTAL, binary_copy=configuration.BINARY_COPY)
 
         index = open(configuration.MAP_TARGET_PATH + '/nativeindex', 'r+b')
         index.truncate(6 * 128 * 128 + 6)
         index.close()
 
-    def selectPopularMap(self, percent, period):
-        query = "SELECT * FROM popular_map(%.2f, interval '%s') LIMIT 1;"
+    def selectPopularMap(self, percent, period, exclude=()):
+        query = "SELECT * FROM popular_map(%.2f, interval '%s') LIMIT %d;"
         with psycopg2.connect(configuration.STATS_DB_DSN) as c:
             with c.cursor() as cur:
-                cur.execute(query % (percent, period))
+                cur.execute(query % (percent, period, len(exclude) + 1))
                 self.logger.debug(cur.query)
-                if cur.rowcount > 0:
-                    row = cur.fetchone()
-                    self.logger.info("Selected map %s [%s] by popularity %.2f" % (row[0], row[1], percent))
-                    return row[0]
+                for row in cur:
+                    if row[0] not in exclude:
+                        self.logger.info("Selected map %s [%s] by popularity %.2f" % (row[0], row[1], percent))
+                        return row[0]
         return None
 
-    def selectDownloadedMap(self, period):
-        query = "SELECT * FROM downloaded_map(interval '%s') LIMIT 1;"
+    def selectChangedMap(self, period, exclude=()):
+        query = "SELECT * FROM changed_map(interval '%s') LIMIT %d;"
         with psycopg2.connect(configuration.STATS_DB_DSN) as c:
             with c.cursor() as cur:
-                cur.execute(query % period)
+                cur.execute(query % (period, len(exclude) + 1))
                 self.logger.debug(cur.query)
-                if cur.rowcount > 0:
-                    row = cur.fetchone()
-                    self.logger.info("Selected map %s [%s] by download status" % (row[0], row[1]))
-                    return row[0]
+                for row in cur:
+                    if row[0] not in exclude:
+                        self.logger.info("Selected map %s [%s] by changes" % (row[0], row[1]))
+                        return row[0]
         return None
 
-    def selectAnyMap(self, period):
-        query = "SELECT * FROM any_map(interval '%s') LIMIT 1;"
+    def selectDownloadedMap(self, period, exclude=()):
+        query = "SELECT * FROM downloaded_map(interval '%s') LIMIT %d;"
         with psycopg2.connect(configuration.STATS_DB_DSN) as c:
             with c.cursor() as cur:
-                cur.execute(query % period)
+                cur.execute(query % (period, len(exclude) + 1))
                 self.logger.debug(cur.query)
-                if cur.rowcount > 0:
-                    row = cur.fetchone()
-                    self.logger.info("Selected map %s [%s]" % (row[0], row[1]))
-                    return row[0]
+                for row in cur:
+                    if row[0] not in exclude:
+                        self.logger.info("Selected map %s [%s] by download status" % (row[0], row[1]))
+                        return row[0]
         return None
 
-    def selectEmptyMap(self, period):
-        query = "SELECT * FROM empty_map(interval '%s') LIMIT 1;"
+    def selectAnyMap(self, period, exclude=()):
+        query = "SELECT * FROM any_map(interval '%s') LIMIT %d;"
         with psycopg2.connect(configuration.STATS_DB_DSN) as c:
             with c.cursor() as cur:
-                cur.execute(query % period)
+                cur.execute(query % (period, len(exclude) + 1))
                 self.logger.debug(cur.query)
-                if cur.rowcount > 0:
-                    row = cur.fetchone()
-                    self.logger.info("Selected map %s [%s] from empty maps" % (row[0], row[1]))
-                    return row[0]
+                for row in cur:
+                    if row[0] not in exclude:
+                        self.logger.info("Selected map %s [%s]" % (row[0], row[1]))
+                        return row[0]
+        return None
+
+    def selectEmptyMap(self, period, exclude=()):
+        query = "SELECT * FROM empty_map(interval '%s') LIMIT %d;"
+        with psycopg2.connect(configuration.STATS_DB_DSN) as c:
+            with c.cursor() as cur:
+                cur.execute(query % (period, len(exclude) + 1))
+                self.logger.debug(cur.query)
+                for row in cur:
+                    if row[0] not in exclude:
+                        self.logger.info("Selected map %s [%s] from empty maps" % (row[0], row[1]))
+                        return row[0]
         return None
 
     def getCost(self, area):
@@ -90,6 +118,17 @@ class MapCreator:
                     return row[0]
         return 0
 
+    def getChanges(self, area):
+        query = "SELECT changes FROM map_changes WHERE area = '%s'"
+        with psycopg2.connect(configuration.STATS_DB_DSN) as c:
+            with c.cursor() as cur:
+                cur.execute(query % area)
+                self.logger.debug(cur.query)
+                if cur.rowcount > 0:
+                    row = cur.fetchone()
+                    return row[0]
+        return 0
+
     def get_last_replication(self):
         query = "SELECT extract(epoch from importdate) FROM osm_replication_status"
         with psycopg2.connect(configuration.STATS_DB_DSN) as c:
@@ -101,7 +140,7 @@ class MapCreator:
                     return row[0]
         return 0
 
-    def loop(self, area=None):
+    def get_data_date(self):
         today = int(time.time() / 3600 / 24)
         if configuration.FROM_FILE:
             date = int(os.path.getmtime(configuration.SOURCE_PBF) / 3600 / 24)
@@ -109,19 +148,32 @@ class MapCreator:
         else:
             date = int(self.get_last_replication() / 3600 / 24)
             self.logger.debug("OSM data is %d days old" % (today - date))
+        return today, date
 
+    def selectMap(self, today, date, exclude=()):
+        area = None
+        if configuration.TRACK_CHANGES:
+            # areas with most changes weighted by popularity go first
+            area = self.selectChangedMap('3 days', exclude)
         if not area and today - date < 7:
-            area = self.selectPopularMap(0.05, '7 days')
+            area = self.selectPopularMap(0.05, '7 days', exclude)
         if not area and today - date < 14:
-            area = self.selectPopularMap(0.1, '14 days')
+            area = self.selectPopularMap(0.1, '14 days', exclude)
         if not area and today - date < 21:
-            area = self.selectPopularMap(0.5, '3 weeks')
+            area = self.selectPopularMap(0.5, '3 weeks', exclude)
         if not area and today - date < 28:
-            area = self.selectDownloadedMap('4 weeks')
+            area = self.selectDownloadedMap('4 weeks', exclude)
         if not area and today - date < 42:
-            area = self.selectAnyMap('6 weeks')
+            area = self.selectAnyMap('6 weeks', exclude)
+        if not area:
+            area = self.selectEmptyMap('2 months', exclude)
+        return area
+
+    def loop(self, area=None):
+        today, date = self.get_data_date()
+
         if not area:
-            area = self.selectEmptyMap('2 months')
+            area = self.selectMap(today, date)
 
         if area is None:
             self.logger.info("No maps to create")
@@ -131,10 +183,16 @@ class MapCreator:
         # raise error flag for current map to prevent dead loops
         self.writeIndex(area, x, y, None, None, None, True)
 
+        map_target_path = '{0:s}/{1:d}/{1:d}-{2:d}.mtiles'.format(configuration.MAP_TARGET_PATH, x, y)
+
+        # changes recorded later are not contained in map data and should remain
+        changes = self.getChanges(area) if configuration.TRACK_CHANGES else 0
+
         cost = time.time()
         timeout = max(self.getCost(area) * 1.5, 60)
         try:
-            map_path = self.mapWriter.createMap(x, y, timeout, configuration.FROM_FILE, False, configuration.FROM_FILE)
+            map_path = self.mapWriter.createMap(x, y, timeout, configuration.FROM_FILE, False, configuration.FROM_FILE,
+                                                previous_map=map_target_path)
         except Exception as ex:
             logger.error(ex)
             if not self.dry_run:
@@ -142,12 +200,10 @@ class MapCreator:
             return 1
         cost = int(time.time() - cost)
 
-        map_target_path = '{0:s}/{1:d}/{1:d}-{2:d}.mtiles'.format(configuration.MAP_TARGET_PATH, x, y)
-
         if map_path is None:
             self.logger.info("Empty map, skipping")
             if not self.dry_run:
-                self.writeIndex(area, x, y, 0, cost, date)
+                self.writeIndex(area, x, y, 0, cost, date, profile=self.mapWriter.profile, changes=changes)
                 if os.path.exists(map_target_path):
                     os.remove(map_target_path)
                     self.logger.info("  removed previously not empty map")
@@ -169,10 +225,98 @@ class MapCreator:
                 print(e)
                 self.writeIndex(area, x, y, None, None, None, True)
                 return 1
-            self.writeIndex(area, x, y, size, cost, date)
+            self.writeIndex(area, x, y, size, cost, date, profile=self.mapWriter.profile, changes=changes)
         return 0
 
-    def writeIndex(self, area, x, y, size, cost, date, error=False):
+    def createArea(self, area, workers):
+        """
+        creates map in child process of parallel loop
+        """
+        setproctitle.setproctitle("mapcreator {}".format(area))
+        self.mapWriter.worker_threads = workers
+        sys.exit(self.loop(area))
+
+    def areaWorkers(self, area, cpus):
+        cost = self.getCost(area)
+        if not cost:
+            workers = DEFAULT_WORKERS
+        else:
+            workers = (cost + WORKER_COST - 1) // WORKER_COST
+        return max(1, min(workers, mapwrite.MAX_WORKERS, cpus))
+
+    @staticmethod
+    def areaMemory(process):
+        """
+        returns memory used by area process and its workers
+        """
+        try:
+            parent = psutil.Process(process.pid)
+            return sum(p.memory_info().rss for p in [parent] + parent.children(recursive=True))
+        except psutil.Error:
+            return 0
+
+    def runParallel(self, jobs, memory_reserve=0.25):
+        """
+        creates up to jobs areas concurrently, each area gets number of workers according to its cost,
+        new area is started only if there are enough free processors for it and memory is not exhausted
+        """
+        cpus = len(os.sched_getaffinity(0))
+        running = {}  # area -> (process, workers)
+        skipped_since = {}  # area -> time when it was first skipped by first fit
+        while True:
+            for area, (p, workers) in list(running.items()):
+                if not p.is_alive():
+                    p.join()
+                    if p.exitcode:
+                        self.logger.error("Failed to create map %s (exit code %d)" % (area, p.exitcode))
+                    del running[area]
+            free = cpus - sum(workers for p, workers in running.values())
+            # recently started areas have not allocated their memory yet, so it is reserved for them
+            memory = psutil.virtual_memory()
+            available = memory.available - sum(max(0, workers * WORKER_MEMORY - self.areaMemory(p)) for p, workers in running.values())
+            started = False
+            if len(running) < jobs and free > 0 and available > memory.total * memory_reserve:
+
+                def fits(workers):
+                    return not running or (workers <= free and workers * WORKER_MEMORY <= available - memory.total * memory_reserve)
+
+                now = time.time()
+                starving = [area for area, since in skipped_since.items() if now - since > STARVATION_TIME]
+                if starving:
+                    # longest skipped area goes next, lighter areas are not started until it fits
+                    area = min(starving, key=skipped_since.get)
+                    workers = self.areaWorkers(area, cpus)
+                    if fits(workers):
+                        self.startArea(area, workers, running)
+                        started = True
+                else:
+                    today, date = self.get_data_date()
+                    # first fit: heavy areas which do not fit are skipped in favor of lighter ones
+                    skipped = set()
+                    while len(skipped) < jobs:
+                        area = self.selectMap(today, date, set(running.keys()) | skipped)
+                        if area is None:
+                            break
+                        workers = self.areaWorkers(area, cpus)
+                        if not fits(workers):
+                            skipped.add(area)
+                            skipped_since.setdefault(area, now)
+                            continue
+                        self.startArea(area, workers, running)
+                        started = True
+                        break
+                if started:
+                    skipped_since.pop(area, None)
+            if not started:
+                time.sleep(5)
+
+    def startArea(self, area, workers, running):
+        self.logger.info("Starting map %s with %d workers" % (area, workers))
+        p = multiprocessing.Process(target=self.createArea, args=(area, workers), name="mapcreator {}".format(area))
+        p.start()
+        running[area] = (p, workers)
+
+    def writeIndex(self, area, x, y, size, cost, date, error=False, profile=None, changes=0):
         if error:
             with psycopg2.connect(configuration.STATS_DB_DSN) as c:
                 with c.cursor() as cur:
@@ -183,15 +327,30 @@ class MapCreator:
                 c.commit()
         else:
             with open(configuration.MAP_TARGET_PATH + '/nativeindex', 'r+b') as index:
-                index.seek((x * 128 + y) * 6)
-                index.write(date.to_bytes(2, byteorder='big', signed=False))
-                index.write(size.to_bytes(4, byteorder='big', signed=False))
+                # record is written at once and under lock as areas can be created concurrently
+                offset = (x * 128 + y) * 6
+                record = date.to_bytes(2, byteorder='big', signed=False) + size.to_bytes(4, byteorder='big', signed=False)
+                fcntl.lockf(index, fcntl.LOCK_EX, 6, offset)
+                try:
+                    os.pwrite(index.fileno(), record, offset)
+                finally:
+                    fcntl.lockf(index, fcntl.LOCK_UN, 6, offset)
             with psycopg2.connect(configuration.STATS_DB_DSN) as c:
                 with c.cursor() as cur:
                     cur.execute("UPDATE maps SET size = %s, cost = %s, created = %s, error = %s WHERE area = %s", (size, cost, date, error, area))
                     if cur.rowcount != 1:
                         cur.execute("INSERT INTO maps (area, size, cost, created) VALUES (%s, %s, %s, %s)", (area, size, cost, date))
                     self.logger.debug(cur.query)
+                    if configuration.STORE_PROFILE and profile is not None:
+                        # breakdown of cost by stages and zooms
+                        cur.execute("UPDATE maps SET profile = %s WHERE area = %s", (json.dumps(profile.summary()), area))
+                        self.logger.debug(cur.query)
+                    if configuration.TRACK_CHANGES and changes:
+                        # map contains only changes counted before it was started
+                        cur.execute("UPDATE map_changes SET changes = changes - %s WHERE area = %s", (changes, area))
+                        self.logger.debug(cur.query)
+                        cur.execute("DELETE FROM map_changes WHERE area = %s AND changes <= 0", (area,))
+                        self.logger.debug(cur.query)
                 c.commit()
 
 
@@ -203,7 +362,10 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--noninteractive', action='store_true', help='forbid interactive mode')
     parser.add_argument('-z', '--daemonize', action='store_true', help='run as a daemon')
     parser.add_argument('-a', '--area', help='create specific area')
+    parser.add_argument('-j', '--parallel', default=1, type=int, help='number of areas created concurrently')
     args = parser.parse_args()
+    if args.parallel > 1 and not args.daemonize:
+        parser.error("parallel creation (-j) requires daemon mode (-z)")
 
     log_level = getattr(logging, args.log.upper(), None)
     if not isinstance(log_level, int):
@@ -226,9 +388,12 @@ if __name__ == "__main__":
                 pidfile=lockfile.FileLock('/var/run/mapcreator.pid'),
             )
             with context:
-                while True:
-                    mapCreator.loop()
-                    time.sleep(5)
+                if args.parallel > 1:
+                    mapCreator.runParallel(args.parallel)
+                else:
+                    while True:
+                        mapCreator.loop()
+                        time.sleep(5)
         else:
             res = mapCreator.loop(args.area)
             if res == -1:
@@ -3,16 +3,19 @@ import os
 import sys
 import gc
 import math
+import shutil
 import time
 import queue
 import threading
 import multiprocessing
 import argparse
+import cProfile
 import subprocess
 import logging.config
 import psutil
 import setproctitle
-from collections import defaultdict, namedtuple
+import numpy
+from collections import defaultdict, deque, namedtuple, OrderedDict
 from datetime import datetime, timedelta
 
 from tqdm import tqdm
@@ -21,10 +24,11 @@ import psycopg2
 import psycopg2.extras
 import osmium
 import mercantile
+import shapely
 import shapely.wkb as shapely_wkb
-from shapely.geometry import MultiLineString, Polygon
+from shapely.geometry import MultiLineString, Point, Polygon
 from shapely.prepared import prep
-from shapely.ops import transform, linemerge, cascaded_union
+from shapely.ops import linemerge, cascaded_union
 from shapely.affinity import affine_transform
 from shapely.errors import WKBReadingError
 
@@ -33,20 +37,72 @@ import mappings
 from encoder import encode
 from util.core import Element
 from util.database import MTilesDatabase
-from util.geometry import wgs84_to_mercator, clockwise, polylabel
+from util.geometry import clockwise, polylabel, geometry_bounds, GeometryIndex
+from util.projection import geometry_to_mercator, geometries_to_mercator, points_to_wgs84
 from util.osm import is_area
 from util.osm.kind import is_place, is_building, get_kind_and_type
 from util.osm.buildings import get_building_properties
 from util.filters import filter_rings
+from util.rules import RuleTable
+from util.store import ElementStore, TileJob, dump_elements
+from util.profiling import Profile
+from util.governor import MemoryGovernor
+from util.fetch import QueryFetcher
+from util.pgcopy import BinaryCopyParser, decode_bytea, decode_int8, decode_hstore
+from util.fingerprint import code_digest, content_hash, tile_fingerprint, FingerprintDatabase, LabelDatabase, PreviousMap
 
 
 logging.getLogger('shapely.geos').setLevel(logging.WARNING)
 
-ProcessJob = namedtuple('ProcessJob', ['id', 'wkb', 'tags', 'mapping', 'simple_polygon'])
-DBJob = namedtuple('DBJob', ['zoom', 'x', 'y', 'features'])
+# vectorized geometry functions are available since Shapely 2.0
+SHAPELY_VECTORIZED = hasattr(shapely, 'get_type_id')
+# vectorization does not pay off for small tiles
+VECTORIZED_MIN_ELEMENTS = 64
+
+ProcessJob = namedtuple('ProcessJob', ['id', 'wkb', 'simple_polygon', 'force_line', 'filter_type'])
+DBJob = namedtuple('DBJob', ['zoom', 'x', 'y', 'features', 'fingerprint'])
+ProfileJob = namedtuple('ProfileJob', ['operations'])
+CopyRow = namedtuple('CopyRow', ['wkb', 'id', 'tags', 'names'])
+
+# maximum number of worker processes
+MAX_WORKERS = configuration.MAX_WORKERS or len(os.sched_getaffinity(0))
+# concurrent database queries
+QUERY_CONNECTIONS = 4
+# rows passed from query at once
+FETCH_BATCH = 1000
+# element query batches prefetched while previous queries are processed
+ELEMENT_BATCHES = 4
+# supplementary query batches waiting to be processed
+SUPPLEMENTARY_BATCHES = 4
+# file elements passed to geometry builder at once
+GEOMETRY_CHUNK = 1000
+# elements passed to element processor at once
+ELEMENT_CHUNK = 500
+# mapping keys used by process_element
+PROCESS_MAPPING_KEYS = ('label', 'basemap-label', 'transform', 'filter-area', 'basemap-filter-area')
 Feature = namedtuple('Feature', ['id', 'geometry', 'area', 'tags', 'kind', 'type', 'label', 'building'])
 
 wkbFactory = osmium.geom.WKBFactory()
+# labels of previous run, set before element processors are forked
+label_database = None
+
+# tag mappings compiled once for all filters
+tag_rules = RuleTable(mappings.tags)
+
+# tags which values are kept as is
+VERBATIM_KEYS = frozenset(('name', 'name:en', 'name:de', 'name:ru', 'ref', 'icao', 'iata', 'addr:housenumber',
+                           'opening_hours', 'wikipedia', 'website'))
+# placeholder of verbatim tag value in cached filter results
+VerbatimValue = namedtuple('VerbatimValue', ['index'])
+
+
+def value_independent(key):
+    rule = tag_rules.rules.get(key, (None, None))[0]
+    return rule is not None and rule.rewrite is None and rule.entry.one_of is None and rule.entry.adjust is None
+
+
+# verbatim tags which mapping does not depend on their value
+PLACEHOLDER_KEYS = frozenset(key for key in VERBATIM_KEYS if value_independent(key))
 
 
 def deep_get(dictionary, *keys):
@@ -59,122 +115,174 @@ def deep_get(dictionary, *keys):
 
 
 class OsmFilter:
-    def __init__(self, elements, basemap, logger):
+    def __init__(self, elements, basemap, logger, cache_size=0):
         self.elements = elements
         self.processors = set()
         self.logger = logger
         self.basemap = basemap
         self.ignorable = 0
+        self.cache = OrderedDict() if cache_size > 0 else None
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self.filter_time = 0.0
 
     def tag_iterator(self, tags):
         return tags.items()
 
     def filter(self, tags):
+        start = time.perf_counter()
+        if self.cache is None:
+            renderable, filtered_tags, mapping, ignorable, processors = self.map_tags(self.tag_iterator(tags))
+        else:
+            key, values = self.cache_key(tags)
+            result = self.cache.get(key, None)
+            if result is None:
+                result = self.map_tags(key)
+                self.cache_misses += 1
+                self.cache[key] = result
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                    self.cache_evictions += 1
+            else:
+                self.cache_hits += 1
+                self.cache.move_to_end(key)
+            renderable, filtered_tags, mapping, ignorable, processors = result
+            # cached result should not be modified, verbatim values are put in place of their placeholders
+            filtered_tags = {k: values[v.index] if type(v) is VerbatimValue else v for k, v in filtered_tags.items()}
+            mapping = dict(mapping)
+        if processors:
+            self.processors.update(processors)
+        if renderable and ignorable:
+            self.ignorable += 1
+        self.filter_time += time.perf_counter() - start
+        return renderable, filtered_tags, mapping
+
+    def cache_key(self, tags):
+        """
+        Returns tags used as cache key and verbatim values. Verbatim values (names, references, etc.) are
+        replaced by placeholders so that named objects share cached results, only values which mapping does
+        not depend on are replaced. Tags which are not mapped are left out as they do not affect result.
+        Tag order is significant for mapping so it is preserved.
+        """
+        key = []
+        values = []
+        for k, v in self.tag_iterator(tags):
+            normalized = k.strip().lower()
+            if normalized not in mappings.tags:
+                continue
+            if normalized in PLACEHOLDER_KEYS and v:
+                key.append((k, VerbatimValue(len(values))))
+                values.append(v)
+            else:
+                key.append((k, v))
+        return tuple(key), values
+
+    def map_tags(self, items):
+        """
+        maps (key, value) pairs of element tags
+        """
         filtered_tags = {}
         mapping = {}
         renderable = False
         ignorable = True
         modifiers = set()
-        for key, value in self.tag_iterator(tags):
+        processors = set()
+        for key, value in items:
             key = key.strip().lower()
-            if key in mappings.tags:
-                m = mappings.tags[key].get('__any__', None)
+            rule = tag_rules.get(key, value)
+            if rule is None:
+                continue
+            m = rule.entry
+            if rule.rewrite is not None:
+                rewrite = rule.rewrite
+                key = rewrite.key
+                if rewrite.if_missing and filtered_tags.get(key, None):
+                    continue
+                if rewrite.value is not None:
+                    value = rewrite.value
+                if rewrite.add_tags is not None:  # preserve original setting
+                    add = mapping.get('add-tags', {})
+                    mapping['add-tags'] = {**add, **rewrite.add_tags}
+                if rewrite.keep_for is not None:  # preserve original setting
+                    keep = mapping.get('keep-for', {})
+                    keep[key] = rewrite.keep_for
+                    mapping['keep-for'] = keep
+                if rewrite.zoom_min is not None:  # account original setting
+                    if 'zoom-min' not in mapping or rewrite.zoom_min < mapping['zoom-min']:
+                        mapping['zoom-min'] = rewrite.zoom_min
+                renderable = renderable or rewrite.render  # account original render flag if it is explicitly set
                 if m is None:
-                    m = mappings.tags[key].get(value, None)
-                if m is not None:  # empty dictionaries should be also accounted
-                    if 'rewrite-key' in m or 'rewrite-value' in m:
-                        key = m.get('rewrite-key', key)
-                        if m.get('rewrite-if-missing', False) and filtered_tags.get(key, None):
-                            continue
-                        value = m.get('rewrite-value', value)
-                        if 'add-tags' in m and 'rewrite-key' in m:  # preserve original setting
-                            add = mapping.get('add-tags', {})
-                            mapping['add-tags'] = {**add, **m['add-tags']}
-                        if 'keep-for' in m and 'rewrite-key' in m:  # preserve original setting
-                            keep = mapping.get('keep-for', {})
-                            keep[key] = m['keep-for']
-                            mapping['keep-for'] = keep
-                        if 'zoom-min' in m:  # account original setting
-                            if 'zoom-min' not in mapping or m['zoom-min'] < mapping['zoom-min']:
-                                mapping['zoom-min'] = m['zoom-min']
-                        render = m.get('render', False)  # account original render flag if it is explicitly set
-                        renderable = renderable or render
-                        m = mappings.tags[key].get(value, mappings.tags[key].get('__any__', {}))
-                    if 'one-of' in m:
-                        if value not in m['one-of']:
-                            continue
-                    if 'adjust' in m:
-                        value = m['adjust'](value)
-                    if value is None:
-                        if key in mapping.get('keep-for', {}):
-                            del mapping['keep-for'][key]
-                        continue
-                    if isinstance(value, str) and key not in ('name', 'name:en', 'name:de', 'name:ru',
-                                                              'ref', 'icao', 'iata', 'addr:housenumber',
-                                                              'opening_hours', 'wikipedia', 'website'):
-                        value = value.strip().lower()
-                        if ';' in value:
-                            value = value.split(';')[0]
-                    filtered_tags[key] = value
-                    render = m.get('render', True)
-                    renderable = renderable or render
-                    ignorable = ignorable and (m.get('ignore', not render))
-                    if 'keep-for' in m:
-                        keep = mapping.get('keep-for', {})
-                        keep[key] = m['keep-for']
-                        mapping['keep-for'] = keep
-                    for k in ('filter-area', 'buffer', 'enlarge', 'simplify', 'force-line', 'label',
-                              'filter-type', 'clip-buffer', 'keep-tags', 'basemap-label',
-                              'basemap-keep-tags', 'basemap-filter-area'):
-                        if k in m:
-                            mapping[k] = m[k]
-                    if 'union' in m:
-                        if 'union' in mapping:
-                            if type(mapping['union']) is dict:
-                                combined_union = mapping['union']
-                            else:
-                                zoom = mapping.get('zoom-min', 0)
-                                combined_union = {k: zoom for k in mapping['union'].split(',')}
-                            if type(m['union']) is dict:
-                                for k, v in m['union'].items():
-                                    if k not in combined_union or combined_union[k] > v:
-                                        combined_union[k] = v
-                            else:
-                                zoom = m.get('zoom-min', 0)
-                                for k in m['union'].split(','):
-                                    if k not in combined_union or combined_union[k] > zoom:
-                                        combined_union[k] = zoom
-                            mapping['union'] = combined_union
-                        else:
-                            mapping['union'] = m['union']
-                    transform_exclusive = m.get('transform-exclusive', False)
-                    if 'transform' in m:
-                        # apply exclusive transform only if this is the first match
-                        if not transform_exclusive or mapping.get('transform-exclusive', None) is None:
-                            mapping['transform'] = m['transform']
-                        elif transform_exclusive:
-                            transform_exclusive = False
-                    if render:
-                        if mapping.get('transform-exclusive', False):
-                            # if there was previous exclusive transform remove it
-                            if 'transform' not in m or transform_exclusive:
-                                del mapping['transform']
-                        mapping['transform-exclusive'] = transform_exclusive
-                    # if 'check-meta' in m:
-                    #     mapping['check-meta'] = m['check-meta'] or mapping.get('check-meta', False)
-                    if 'union-zoom-max' in m:
-                        if 'union-zoom-max' not in mapping or m['union-zoom-max'] < mapping['union-zoom-max']:
-                            mapping['union-zoom-max'] = m['union-zoom-max']
-                    if 'zoom-min' in m:
-                        if 'zoom-min' not in mapping or m['zoom-min'] < mapping['zoom-min']:
-                            mapping['zoom-min'] = m['zoom-min']
-                    if 'zoom-max' in m:
-                        if 'zoom-max' not in mapping or m['zoom-max'] > mapping['zoom-max']:
-                            mapping['zoom-max'] = m['zoom-max']
-                    if 'modify-mapping' in m:
-                        modifiers.add(m['modify-mapping'])
-                    if 'pre-process' in m:
-                        self.processors.add(m['pre-process'])
+                    m = tag_rules.target(key, value)
+            if m.one_of is not None:
+                if value not in m.one_of:
+                    continue
+            if m.adjust is not None:
+                value = m.adjust(value)
+            if value is None:
+                if key in mapping.get('keep-for', {}):
+                    del mapping['keep-for'][key]
+                continue
+            if isinstance(value, str) and key not in VERBATIM_KEYS:
+                value = value.strip().lower()
+                if ';' in value:
+                    value = value.split(';')[0]
+            filtered_tags[key] = value
+            render = m.render
+            renderable = renderable or render
+            ignorable = ignorable and m.ignore
+            if m.keep_for is not None:
+                keep = mapping.get('keep-for', {})
+                keep[key] = m.keep_for
+                mapping['keep-for'] = keep
+            if m.plain:
+                mapping.update(m.plain)
+            if m.union is not None:
+                if 'union' in mapping:
+                    if type(mapping['union']) is dict:
+                        combined_union = dict(mapping['union'])  # do not modify original mapping
+                    else:
+                        zoom = mapping.get('zoom-min', 0)
+                        combined_union = {k: zoom for k in mapping['union'].split(',')}
+                    if type(m.union) is dict:
+                        for k, v in m.union.items():
+                            if k not in combined_union or combined_union[k] > v:
+                                combined_union[k] = v
+                    else:
+                        zoom = m.zoom_min if m.zoom_min is not None else 0
+                        for k in m.union.split(','):
+                            if k not in combined_union or combined_union[k] > zoom:
+                                combined_union[k] = zoom
+                    mapping['union'] = combined_union
+                else:
+                    mapping['union'] = m.union
+            transform_exclusive = m.transform_exclusive
+            if m.transform is not None:
+                # apply exclusive transform only if this is the first match
+                if not transform_exclusive or mapping.get('transform-exclusive', None) is None:
+                    mapping['transform'] = m.transform
+                elif transform_exclusive:
+                    transform_exclusive = False
+            if render:
+                if mapping.get('transform-exclusive', False):
+                    # if there was previous exclusive transform remove it
+                    if m.transform is None or transform_exclusive:
+                        del mapping['transform']
+                mapping['transform-exclusive'] = transform_exclusive
+            if m.union_zoom_max is not None:
+                if 'union-zoom-max' not in mapping or m.union_zoom_max < mapping['union-zoom-max']:
+                    mapping['union-zoom-max'] = m.union_zoom_max
+            if m.zoom_min is not None:
+                if 'zoom-min' not in mapping or m.zoom_min < mapping['zoom-min']:
+                    mapping['zoom-min'] = m.zoom_min
+            if m.zoom_max is not None:
+                if 'zoom-max' not in mapping or m.zoom_max > mapping['zoom-max']:
+                    mapping['zoom-max'] = m.zoom_max
+            if m.modifier is not None:
+                modifiers.add(m.modifier)
+            if m.processor is not None:
+                processors.add(m.processor)
 
         for modifier in modifiers:
             renderable, ignorable, mapping = modifier(filtered_tags, renderable, ignorable, mapping)
@@ -198,9 +306,7 @@ class OsmFilter:
                 # noinspection PyUnresolvedReferences
                 keep = [x.strip() for x in tag_filter.split(',')]
                 filtered_tags = {k: filtered_tags[k] for k in set(keep) & set(filtered_tags.keys())}
-            if ignorable:
-                self.ignorable += 1
-        return renderable, filtered_tags, mapping
+        return renderable, filtered_tags, mapping, ignorable, processors
 
     def get_osm_id(self, t, o):
         return abs(o.id)
@@ -221,49 +327,54 @@ class OsmFilter:
     def wkb(self, t, o):
         return o.wkb
 
-    def simplify(self, t, o, geom):
-        if geom.geom_type == 'MultiPolygon' and len(geom.geoms) == 1:
-            return geom[0]
-        return geom
-
-    def validate(self, t, o, geom):
-        return geom
+    def simple_polygon(self, t, o):
+        return None
 
     def from_way(self, o):
         return o.id > 0
 
-    def process(self, srid, t, o):
+    def prepare(self, srid, t, o):
+        """
+        filters object tags, returns geometry job, tags and mapping if object is renderable
+        """
         if len(o.tags) == 0:
-            return
-        if o.names:
-            for k, v in o.names.items():
+            return None
+        names = getattr(o, 'names', None)  # only database rows have separate names
+        if names:
+            for k, v in names.items():
                 o.tags['name:{}'.format(k) if k else 'name'] = v
         renderable, tags, mapping = self.filter(o.tags)
-        if renderable:
-            if self.skip(t, o, tags):
-                return
-            try:
-                geom = shapely_wkb.loads(self.wkb(t, o), hex=True)
-                if srid != 3857:  # we support only 3857 and 4326 projections
-                    geom = transform(wgs84_to_mercator, geom)
-                geom = self.simplify(t, o, geom)
-                if mapping.pop('force-line', False) and geom.type in ['Polygon', 'MultiPolygon']:
-                    geom = geom.boundary
-                if 'filter-type' in mapping and geom.type not in mapping.pop('filter-type', []):
-                    return
-                geom = clockwise(geom)
-                geom = self.validate(t, o, geom)
-                # construct unique id
-                if t == 3 and self.from_way(o):
-                    t = 2
-                osm_id = self.get_osm_id(t, o)
-                el_id = (osm_id << 2) + t
-                self.elements.append(Element(el_id, geom, tags, mapping))
-            except Exception as ex:
-                ref = self.get_osm_ref(t, o)
-                self.logger.error("   %s: %s", ref, ex)
+        if not renderable or self.skip(t, o, tags):
+            return None
+        try:
+            wkb = self.wkb(t, o)
+        except Exception as ex:
+            self.logger.error("   %s: %s", self.get_osm_ref(t, o), ex)
+            return None
+        # construct unique id
+        el_type = 2 if t == 3 and self.from_way(o) else t
+        el_id = (self.get_osm_id(el_type, o) << 2) + el_type
+        job = ProcessJob(el_id, wkb, self.simple_polygon(t, o), mapping.pop('force-line', False), mapping.pop('filter-type', None))
+        return job, tags, mapping
+
+    def process(self, srid, t, o):
+        prepared = self.prepare(srid, t, o)
+        if prepared is None:
+            return
+        job, tags, mapping = prepared
+        geom, error = build_geometry(srid, job)
+        if error:
+            self.logger.error("   %s: %s", element_ref(job.id), error)
+        elif geom is not None:
+            self.elements.append(Element(job.id, geom, tags, mapping))
 
     def finish(self):
+        if self.cache is not None:
+            lookups = self.cache_hits + self.cache_misses
+            self.logger.info("    filter cache: %d hits of %d lookups (%.1f%%), %d evictions, size %d of %d",
+                             self.cache_hits, lookups, 100 * self.cache_hits / lookups if lookups else 0,
+                             self.cache_evictions, len(self.cache), self.cache_size)
+            self.cache = None
         if self.ignorable:
             if len(self.elements) <= self.ignorable:  # it can be less as closed ways from file are processed twice
                 self.elements.clear()
@@ -273,10 +384,63 @@ class OsmFilter:
 
 
 class OsmFileFilter(osmium.SimpleHandler, OsmFilter):
-    def __init__(self, elements, basemap, logger):
+    """
+    Reads elements from file, objects without tags are dropped by osmium before they reach Python. Tags are
+    filtered while object is read and geometries are built in chunks, optionally by process pool.
+    """
+    def __init__(self, elements, basemap, logger, cache_size=0, workers=1, proc_name=None):
         osmium.SimpleHandler.__init__(self)
-        OsmFilter.__init__(self, elements, basemap, logger)
+        OsmFilter.__init__(self, elements, basemap, logger, cache_size)
         self.outlines = set()
+        self.chunk = []
+        self.pending = deque()  # chunks in file order: (jobs, tags and mappings, result)
+        self.pool = None
+        self.max_pending = 2 * workers
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers, initializer=element_processing_initializer, initargs=(proc_name,))
+
+    def apply_file(self, filename):
+        super().apply_file(filename, filters=[osmium.filter.EmptyTagFilter()])
+        self.flush()
+        while self.pending:
+            self.collect()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def process(self, srid, t, o):
+        prepared = self.prepare(srid, t, o)
+        if prepared is None:
+            return
+        job, tags, mapping = prepared
+        # osmium object is not valid after handler returns so only its binary geometry is kept
+        self.chunk.append((job._replace(wkb=bytes.fromhex(job.wkb)), tags, mapping))
+        if len(self.chunk) >= GEOMETRY_CHUNK:
+            self.flush()
+
+    def flush(self):
+        if not self.chunk:
+            return
+        jobs = [job for job, tags, mapping in self.chunk]
+        if self.pool:
+            result = self.pool.apply_async(build_geometries, (4326, jobs, True))
+        else:
+            result = None
+        self.pending.append((self.chunk, result if result else build_geometries(4326, jobs, True)))
+        self.chunk = []
+        while len(self.pending) > self.max_pending or (self.pending and not self.pool):
+            self.collect()
+
+    def collect(self):
+        chunk, result = self.pending.popleft()
+        if not isinstance(result, list):
+            result = result.get()
+        for (job, tags, mapping), (geom, error) in zip(chunk, result):
+            if error:
+                self.logger.error("   %s: %s", element_ref(job.id), error)
+            elif geom is not None:
+                self.elements.append(Element(job.id, geom, tags, mapping))
 
     def tag_iterator(self, tags):
         for tag in tags:
@@ -307,21 +471,9 @@ class OsmFileFilter(osmium.SimpleHandler, OsmFilter):
         else:  # can not happen but is required by lint
             return None
 
-    def simplify(self, t, o, geom):
-        if t == 3 and not o.is_multipolygon():
-            return geom[0]  # simplify geometry
-        else:
-            return geom
-
-    def validate(self, t, o, geom):
-        if not geom.is_valid:
-            geom = geom.buffer(0)
-            ref = self.get_osm_ref(t, o)
-            if geom.is_valid:
-                logging.warning(" invalid geom %s fixed", ref)
-            else:
-                logging.warning(" invalid geom %s NOT fixed", ref)
-        return geom
+    def simple_polygon(self, t, o):
+        # area built from closed way
+        return t == 3 and not o.is_multipolygon()
 
     def from_way(self, o):
         return o.from_way()
@@ -364,11 +516,12 @@ class Tile:
     SCALE = 4096
     INITIAL_RESOLUTION = CIRCUMFERENCE / SIZE
 
-    def __init__(self, zoom, x, y, elements=None):
+    def __init__(self, zoom, x, y, elements=None, clipped=None):
         self.zoom = zoom
         self.x = x
         self.y = y
         self.elements = elements if elements else []
+        self.clipped = clipped if clipped else set()  # indices of clipped stored elements
         self.pixelWidth = self.INITIAL_RESOLUTION / 2 ** self.zoom
         self.bounds = mercantile.xy_bounds(x, y, zoom)
         self.matrix = [Tile.SCALE / (self.bounds.right - self.bounds.left), 0, 0,
@@ -397,13 +550,158 @@ class BBoxCache(defaultdict):
         return bbox
 
 
+def element_ref(el_id):
+    t = el_id & 3
+    return '{}/{}'.format('node' if t == 1 else 'way' if t == 2 else 'relation', el_id >> 2)
+
+
+def build_geometry(srid, job, fix_invalid=False):
+    """
+    Builds element geometry in Web Mercator, returns (geometry, error), geometry is None if it is filtered
+    out by type. Simple polygon flag is True for areas built from closed way, False for multipolygons and
+    None if it is not known, then single part multipolygon is simplified.
+    """
+    try:
+        geom = shapely_wkb.loads(job.wkb, hex=isinstance(job.wkb, str))
+        if srid != 3857:  # we support only 3857 and 4326 projections
+            geom = geometry_to_mercator(geom)
+        if job.simple_polygon or (job.simple_polygon is None and geom.geom_type == 'MultiPolygon' and len(geom.geoms) == 1):
+            geom = geom.geoms[0]
+        if job.force_line and geom.type in ['Polygon', 'MultiPolygon']:
+            geom = geom.boundary
+        if job.filter_type is not None and geom.type not in job.filter_type:
+            return None, None
+        geom = clockwise(geom)
+        if fix_invalid and not geom.is_valid:
+            geom = geom.buffer(0)
+            if geom.is_valid:
+                logging.warning(" invalid geom %s fixed", element_ref(job.id))
+            else:
+                logging.warning(" invalid geom %s NOT fixed", element_ref(job.id))
+        return geom, None
+    except Exception as ex:
+        return None, str(ex)
+
+
+def build_geometries(srid, jobs, fix_invalid=False):
+    return [build_geometry(srid, job, fix_invalid) for job in jobs]
+
+
+def element_batch(elements, chunk, basemap):
+    """
+    Returns compact representation of elements for process_elements: WKB, tags and only used mapping keys
+    """
+    items = []
+    for index in chunk:
+        el = elements[index]
+        items.append((el.geom.wkb, el.tags, {k: el.mapping[k] for k in PROCESS_MAPPING_KEYS if k in el.mapping}))
+    return basemap, items
+
+
+def encode_label(label):
+    if label is None:
+        return None
+    if isinstance(label, list):
+        return [(point.x, point.y) for point in label]
+    return label.x, label.y
+
+
+def decode_label(coords):
+    if coords is None:
+        return None
+    if isinstance(coords, list):
+        return [Point(c) for c in coords]
+    return Point(coords)
+
+
+def set_label_database(labels):
+    global label_database
+    label_database = labels
+
+
+def process_elements(batch):
+    """
+    Processes chunk of elements, returns arrays of kinds, types (-1 for None) and areas (NaN for None),
+    label coordinates, building properties and geometry hashes of building labels (None if labels are
+    not cached)
+    """
+    basemap, items = batch
+    hashes = None
+    cached = {}
+    if label_database is not None:
+        hashes = [content_hash(wkb) for wkb, _, _ in items]
+        cached = label_database.lookup(hashes)
+    kinds = numpy.empty(len(items), dtype=numpy.int64)
+    types = numpy.empty(len(items), dtype=numpy.int64)
+    areas = numpy.empty(len(items), dtype=numpy.float64)
+    labels = []
+    buildings = []
+    for i, (wkb, tags, mapping) in enumerate(items):
+        known = cached.get(hashes[i]) if hashes else None
+        kind, el_type, area, label, building = process_element(shapely_wkb.loads(wkb), tags, mapping, basemap, decode_label(known))
+        kinds[i] = -1 if kind is None else kind
+        types[i] = -1 if el_type is None else el_type
+        areas[i] = numpy.nan if area is None else area
+        labels.append(encode_label(label))
+        buildings.append(building)
+        if hashes and (building is None or label is None):
+            hashes[i] = None
+    return kinds, types, areas, labels, buildings, hashes
+
+
+def place_key(tags, default):
+    return '{}@{}'.format(tags.get('place', default), tags.get('name', default).split(' (')[0])
+
+
+def merge_places(places):
+    """
+    Removes overlapping places: names of place polygon are copied to the place point it contains and
+    polygon is marked as merged. Points are indexed by place and name, so the result does not depend on
+    element order. Returns number of merged polygons.
+    """
+    points = defaultdict(list)
+    for el in places:
+        if el.geom.type == 'Point':
+            points[place_key(el.tags, '---')].append(el)
+    if not points:
+        return 0
+    indexes = {}
+    merged = 0
+    for el in places:
+        if el.geom.type == 'Point':
+            continue
+        key = place_key(el.tags, '===')
+        if key not in points:
+            continue
+        if key not in indexes:
+            indexes[key] = GeometryIndex([place.geom for place in points[key]])
+        prepared = None
+        for i in indexes[key].query(el.geom):
+            place = points[key][i]
+            if prepared is None:
+                prepared = prep(el.geom)
+            if prepared.contains(place.geom):
+                # copy names to point and remove them from polygon
+                for tag in ('name:en', 'name:de', 'name:ru'):
+                    if tag in el.tags:
+                        name = el.tags.pop(tag)
+                        if tag not in place.tags:
+                            place.tags[tag] = name
+                el.tags.pop('name', None)
+                el.tags.pop('place', None)
+                el.merged = True
+                merged += 1
+                break
+    return merged
+
+
 def element_processing_initializer(proc_name):
     name = "{} element processor {}".format(proc_name, multiprocessing.current_process().name.split('-')[1])
     multiprocessing.current_process().name = name
     setproctitle.setproctitle(name)
 
 
-def process_element(geom, tags, mapping, basemap=False):
+def process_element(geom, tags, mapping, basemap=False, known_label=None):
     kind, el_type = get_kind_and_type(tags)
     if is_building(kind):
         building = get_building_properties(tags)
@@ -415,7 +713,7 @@ def process_element(geom, tags, mapping, basemap=False):
 
     if el_type or (mapping.get('label', False) and (not basemap or mapping.get('basemap-label', False))):
         if building is not None:
-            label, area = polylabel(geom)
+            label, area = polylabel(geom, known_label)
         else:
             if geom.type in ('Polygon', 'MultiPolygon'):
                 area = geom.area
@@ -446,9 +744,30 @@ def process_element(geom, tags, mapping, basemap=False):
 
 # noinspection PyPep8Naming
 class MapWriter:
-    def __init__(self, data_dir, dry_run=False, forbid_interactive=False, single_thread=False):
-        self.dry_run = dry_run
+    def __init__(self, data_dir, dry_run=False, forbid_interactive=False, single_thread=False, filter_cache=0,
+                 subtree_zoom=0, vectorized=False, dump_path=None, cprofile=False, dedup=False, incremental=False,
+                 binary_copy=False):
         self.logger = logging.getLogger(__name__)
+        self.dry_run = dry_run
+        self.binary_copy = binary_copy  # read database elements with binary COPY
+        self.dedup = dedup
+        self.incremental = incremental  # reuse tiles of previous map which input has not changed
+        self.fingerprint_salt = None
+        self.fingerprints = None
+        self.labels = None
+        self.previous = None
+        self.dump_path = dump_path
+        self.filter_cache = filter_cache
+        self.subtree_zoom = subtree_zoom  # tiles below this zoom are generated locally by worker (0 - disabled)
+        self.local_tiles = None
+        self.idle_workers = None
+        self.governor = None
+        self.vectorized = vectorized and SHAPELY_VECTORIZED
+        if vectorized and not self.vectorized:
+            self.logger.warning("Vectorized processing requires Shapely 2.0+, falling back to per element processing")
+        self.cprofile = cprofile
+        self.cprofile_path = None
+        self.profile = Profile()
         self.data_dir = data_dir
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
@@ -459,11 +778,12 @@ class MapWriter:
         self.db = None
         self.tile_queue = None
         self.db_queue = None
+        self.store = None
         self.proc_name = "mapwrite"
         if single_thread:
             self.worker_threads = 1
         else:
-            self.worker_threads = 6  # hardcoded maximum, can be any positive value
+            self.worker_threads = MAX_WORKERS
         self.proc_progress = None
         self.gen_progress = None
 
@@ -476,7 +796,7 @@ class MapWriter:
         except ImportError:
             self.logger.warning("Upgrade Shapely for performance improvements")
 
-    def createMap(self, x, y, timeout=0, intermediate=False, keep=False, from_file=False, bbox_override=None):
+    def createMap(self, x, y, timeout=0, intermediate=False, keep=False, from_file=False, bbox_override=None, previous_map=None):
         self.stubmap = x == -2 and y == -2
         self.basemap = self.stubmap or (x == -1 and y == -1)
 
@@ -498,6 +818,13 @@ class MapWriter:
         map_path = self.map_path(x, y)
         self.logger.info("Creating map: %s" % map_path)
 
+        self.profile = Profile()
+        profiler = None
+        if self.cprofile:
+            self.cprofile_path = self.map_path_base(x, y) + ".prof"
+            profiler = cProfile.Profile()
+            profiler.enable()
+
         if from_file:
             pbf_path = self.pbf_path(x, y)
             self.timestamp = os.path.getmtime(configuration.SOURCE_PBF)
@@ -514,18 +841,20 @@ class MapWriter:
                         self.generateIntermediateFile(source_pbf_path, x, y, 7, "")
 
         start_time = datetime.utcnow()
+        stage_start = time.perf_counter()
 
+        previous_aside = None
         elements = []
         if from_file:
             # noinspection PyUnboundLocalVariable
             self.logger.info("  Processing file: %s" % pbf_path)
-            handler = OsmFileFilter(elements, self.basemap, self.logger)
+            workers = max(1, min(self.worker_threads, len(os.sched_getaffinity(0))))
+            handler = OsmFileFilter(elements, self.basemap, self.logger, self.filter_cache, workers, self.proc_name)
             handler.apply_file(pbf_path)
             processors = handler.finish()
-            del handler
         else:
             self.logger.info("  Processing elements from database")
-            handler = OsmFilter(elements, self.basemap, self.logger)
+            handler = OsmFilter(elements, self.basemap, self.logger, self.filter_cache)
             with psycopg2.connect(configuration.DATA_DB_DSN, cursor_factory=psycopg2.extras.NamedTupleCursor) as c:
                 psycopg2.extras.register_hstore(c)
                 with c.cursor() as cur:
@@ -555,6 +884,11 @@ class MapWriter:
                         bbox = "ST_MakeEnvelope({left}, {bottom}, {right}, {top}, 3857)" \
                             .format(left=(bounds.left - left_expand), bottom=(bounds.bottom - expand),
                                     right=(bounds.right + right_expand), top=(bounds.top + expand))
+            # queries are executed concurrently but processed in their order to keep element order stable
+            fetcher = QueryFetcher(configuration.DATA_DB_DSN, QUERY_CONNECTIONS, self.logger,
+                                   psycopg2.extras.register_hstore, cursor_factory=psycopg2.extras.NamedTupleCursor)
+            try:
+                results = []
                 for data in queries:
                     if self.basemap:
                         sql = data['query']
@@ -565,27 +899,29 @@ class MapWriter:
                             qbbox = bbox
                         sql = "{query} WHERE ST_Intersects(geom, {bbox})" \
                             .format(query=data['query'], bbox=qbbox)
-                    with c.cursor('large') as cur:
-                        try:
-                            n = 0
-                            cur.itersize = 1000
-                            cur.execute(sql)
-                            self.logger.debug("   %s", cur.query.decode())
-                            for row in cur:
-                                handler.process(data['srid'], data['type'], row)
-                                n += 1
-                            self.logger.debug("   fetched %d elements", n)
-                        except (psycopg2.ProgrammingError, psycopg2.InternalError):
-                            self.logger.exception("Query error: %s" % sql)
+                    # results are streamed so memory is bounded by batch size, not by result size
+                    results.append((data, fetcher.submit(self.fetchElements, sql, ELEMENT_BATCHES)))
+                for data, batches in results:
+                    n = 0
+                    for rows in batches:
+                        for row in rows:
+                            handler.process(data['srid'], data['type'], row)
+                        n += len(rows)
+                    self.logger.debug("   fetched %d elements", n)
+            finally:
+                fetcher.close()
             processors = handler.finish()
-            del handler
+        # tag filtering is interleaved with reading so it is measured separately
+        self.profile.add_stage('read', time.perf_counter() - stage_start - handler.filter_time)
+        self.profile.add_stage('filter', handler.filter_time)
+        del handler
 
         gc.collect()
 
         process = psutil.Process(os.getpid())
         used = process.memory_info().rss // 1048576
         available = psutil.virtual_memory().available // 1048576 + used
-        self.worker_threads = max(1, min(self.worker_threads, int(available / used / 2), len(os.sched_getaffinity(0))))
+        self.worker_threads = max(1, min(self.worker_threads, len(os.sched_getaffinity(0))))
         self.logger.info("    memory used: {:,}M out of {:,}M".format(used, available))
 
         # process map only if it contains relevant data
@@ -595,9 +931,29 @@ class MapWriter:
 
             for processor in processors:
                 self.logger.info("    calling pre-processor %s.%s" % (processor.__module__, processor.__name__))
-                processor(elements, self.interactive)
-
-            self.db = MTilesDatabase(map_path)
+                with self.profile.stage('pre-process %s' % processor.__name__):
+                    processor(elements, self.interactive)
+
+            if self.incremental:
+                self.fingerprint_salt = code_digest(os.path.dirname(os.path.abspath(__file__)), self.basemap, self.stubmap, self.vectorized)
+                self.fingerprints = FingerprintDatabase(self.fingerprints_path(x, y))
+                fingerprints = self.fingerprints.load()
+                if previous_map is None and os.path.exists(map_path):
+                    # new map is written to the same path, copy of previous map is kept until new map is
+                    # complete, copy left by failed run is the last good map so it is not overwritten
+                    previous_aside = map_path + ".previous"
+                    if not os.path.exists(previous_aside):
+                        shutil.copyfile(map_path, previous_aside)
+                    previous_map = previous_aside
+                if fingerprints and previous_map and os.path.exists(previous_map):
+                    self.logger.info("    reusing unchanged tiles of %s" % previous_map)
+                    self.previous = PreviousMap(previous_map, fingerprints)
+                self.fingerprints.create()
+                self.labels = LabelDatabase(self.labels_path(x, y), self.fingerprint_salt)
+                set_label_database(self.labels if self.labels.valid() else None)
+                self.labels.create()
+
+            self.db = MTilesDatabase(map_path, dedup=self.dedup)
             if self.basemap:
                 self.db.create("basemap", 'baselayer', self.timestamp, 'maptrek')
             else:
@@ -605,101 +961,53 @@ class MapWriter:
 
             used = process.memory_info().rss // 1048576
             available = psutil.virtual_memory().available // 1048576 + used
-            self.worker_threads = min(self.worker_threads, max(1, int(available / used / 2)))
             self.logger.info("    memory used: {:,}M out of {:,}M".format(used, available))
 
-            if self.basemap and not self.stubmap:
-                # temporary hack
-                self.worker_threads = min(2, self.worker_threads)
-            if self.worker_threads > 1:
-                self.logger.info("    running in multiprocessing mode with %d workers" % self.worker_threads)
-            else:
-                self.logger.info("    running in single threaded mode")
-
             pool = None
             if self.worker_threads > 1 and len(elements) > 100:
-                pool = multiprocessing.Pool(self.worker_threads, initializer=element_processing_initializer, initargs=(self.proc_name,))
+                # element processing is short, its pool is sized once by current process memory
+                pool_workers = min(self.worker_threads, max(1, int(available / used / 2)))
+                self.logger.info("    processing elements with %d workers" % pool_workers)
+                pool = multiprocessing.Pool(pool_workers, initializer=element_processing_initializer, initargs=(self.proc_name,))
 
             if self.interactive:
                 self.proc_progress = tqdm(total=len(elements), desc="Processed", maxinterval=1.0)
             else:
                 self.logger.info("    processing %d elements" % len(elements))
 
-            results = []
-            places = defaultdict(list)
-            # pre-process elements
+            stage_start = time.perf_counter()
+            chunks = []
             for idx, element in enumerate(elements):
-                def process_result(result, index=idx):
-                    el = elements[index]
-                    el.kind, el.type, el.area, el.label, el.building = result
-                    # remove overlapping places (point and polygon)
-                    # we assume that points go first, if not - introduce sort
-                    if el.id and is_place(el.kind):
-                        if el.geom.type == 'Point':
-                            key = '{}@{}'.format(el.tags.get('place', '---'), el.tags.get('name', '---').split(' (')[0])
-                            places[key].append(el)
-                        elif len(places):
-                            key = '{}@{}'.format(el.tags.get('place', '==='), el.tags.get('name', '===').split(' (')[0])
-                            for place in places[key]:
-                                if el.geom.contains(place.geom):
-                                    # copy names to point and remove them from polygon
-                                    if 'name:en' in el.tags:
-                                        name = el.tags.pop('name:en', None)
-                                        if 'name:en' not in place.tags:
-                                            place.tags['name:en'] = name
-                                    if 'name:de' in el.tags:
-                                        name = el.tags.pop('name:de', None)
-                                        if 'name:de' not in place.tags:
-                                            place.tags['name:de'] = name
-                                    if 'name:ru' in el.tags:
-                                        name = el.tags.pop('name:ru', None)
-                                        if 'name:ru' not in place.tags:
-                                            place.tags['name:ru'] = name
-                                    el.tags.pop('name', None)
-                                    el.tags.pop('place', None)
-                                    el.merged = True
-                                    break
-
-                    if 'transform' in el.mapping:
-                        if el.mapping.get('transform') == 'point' and el.geom.type != 'Point':
-                            if el.label:
-                                if isinstance(el.label, list):
-                                    el.geom = el.label[0]
-                                else:
-                                    el.geom = el.label
-                            else:
-                                el.geom = el.geom.representative_point()
-
-                    # if feature has type or name save it for future reference
-                    if el.type or 'name' in el.tags:
-                        self.db.putFeature(el.id, el.tags, el.kind, el.type, el.label, el.geom)
-                        el.tags.pop('name:en', None)
-                        el.tags.pop('name:de', None)
-                        el.tags.pop('name:ru', None)
-                        el.tags.pop('opening_hours', None)
-                        el.tags.pop('website', None)
-                        el.tags.pop('phone', None)
-                        el.tags.pop('wikipedia', None)
-                        el.tags['id'] = el.id
-                    if self.interactive:
-                        self.proc_progress.update()
                 if element.geom.is_empty:
                     self.logger.error("   got empty geom for %s" % element.osm_id())
                     element.tags.clear()  # clean all tags to later remove element
                     continue
-                if pool:
-                    results.append(pool.apply_async(
-                        process_element, [element.geom, element.tags, element.mapping, self.basemap],
-                        callback=process_result
-                    ))
-                else:
-                    process_result(process_element(element.geom, element.tags, element.mapping, self.basemap))
+                if not chunks or len(chunks[-1]) >= ELEMENT_CHUNK:
+                    chunks.append([])
+                chunks[-1].append(idx)
+            batches = (element_batch(elements, chunk, self.basemap) for chunk in chunks)
+            errors = []
             if pool:
+                def consume():
+                    try:
+                        self.applyResults(elements, chunks, pool.imap(process_elements, batches))
+                    except Exception as e:
+                        errors.append(e)
+
+                # results are applied in element order while supplementary data is fetched
+                consumer = threading.Thread(target=consume, name="{} element results".format(self.proc_name))
+                consumer.start()
                 pool.close()
+            else:
+                consumer = None
+                self.applyResults(elements, chunks, map(process_elements, batches))
+            self.profile.add_stage('process', time.perf_counter() - stage_start)
 
+            stage_start = time.perf_counter()
             extra_elements = []
             # get supplementary data while elements are processed
-            with psycopg2.connect(configuration.DATA_DB_DSN) as c:
+            fetcher = QueryFetcher(configuration.DATA_DB_DSN, QUERY_CONNECTIONS, self.logger)
+            try:
                 if self.stubmap:
                     queries = mappings.stubmap_supplementary_queries
                 elif self.basemap:
@@ -720,6 +1028,7 @@ class MapWriter:
                         bbox = "ST_MakeEnvelope({left}, {bottom}, {right}, {top}, 3857)" \
                                .format(left=(bounds.left - left_expand), bottom=(bounds.bottom - expand),
                                        right=(bounds.right + right_expand), top=(bounds.top + expand))
+                results = []
                 for data in queries:
                     # encapsulate query as it can contain its own WHERE clause
                     if self.basemap:
@@ -730,16 +1039,24 @@ class MapWriter:
                         else:
                             qbbox = bbox
                         sql = "SELECT * FROM ({query}) AS data WHERE ST_Intersects(geom, {bbox})".format(query=data['query'], bbox=qbbox)
-                    try:
-                        cur = c.cursor(cursor_factory=psycopg2.extras.DictCursor)
-                        cur.execute(sql)
-                        self.logger.debug("     %s", cur.query.decode())
-                        rows = cur.fetchall()
-                        self.logger.debug("     fetched %d elements", len(rows))
+                    # results are streamed so memory is bounded by batch size, not by result size
+                    results.append((data, fetcher.submit(self.fetchSupplementary, sql, SUPPLEMENTARY_BATCHES)))
+                for data, batches in results:
+                    n = 0
+                    for rows in batches:
+                        n += len(rows)
+                        geoms = []
                         for row in rows:
-                            geom = shapely_wkb.loads(row['geom'], hex=True)
-                            if data['srid'] != 3857:  # we support only 3857 and 4326 projections
-                                geom = transform(wgs84_to_mercator, geom)
+                            try:
+                                geoms.append(shapely_wkb.loads(row['geom'], hex=True))
+                            except WKBReadingError:
+                                self.logger.error("Geometry error: %s" % row['geom'])
+                                geoms.append(None)
+                        rows = [row for row, geom in zip(rows, geoms) if geom is not None]
+                        geoms = [geom for geom in geoms if geom is not None]
+                        if data['srid'] != 3857:  # we support only 3857 and 4326 projections
+                            geoms = geometries_to_mercator(geoms)
+                        for row, geom in zip(rows, geoms):
                             kind, tags, mapping = data['mapper'](row)
                             if mapping.pop('force-line', False) and geom.type in ['Polygon', 'MultiPolygon']:
                                 geom = geom.boundary
@@ -747,19 +1064,24 @@ class MapWriter:
                             if kind:
                                 element.kind = kind
                             extra_elements.append(element)
-                    except (psycopg2.ProgrammingError, psycopg2.InternalError):
-                        self.logger.exception("Query error: %s" % sql)
-                    except WKBReadingError:
-                        self.logger.error("Geometry error: %s" % row['geom'])
-                    finally:
-                        cur.close()
-
-            if self.worker_threads > 1:
-                # wait for results, look for errors
-                for r in results:
-                    r.get()
-                del pool
-                del results
+                        del rows, geoms
+                    self.logger.debug("     fetched %d elements", n)
+            finally:
+                fetcher.close()
+            self.profile.add_stage('supplementary', time.perf_counter() - stage_start)
+
+            if consumer:
+                # wait for results
+                with self.profile.stage('process'):
+                    consumer.join()
+                pool.join()
+                if errors:
+                    raise errors[0]
+            del pool
+            if self.labels:
+                set_label_database(None)
+                self.labels.finish()
+                self.labels = None
 
             if self.interactive:
                 self.proc_progress.close()
@@ -795,16 +1117,21 @@ class MapWriter:
 
             used = process.memory_info().rss // 1048576
             available = psutil.virtual_memory().available // 1048576 + used
-            self.worker_threads = min(self.worker_threads, max(1, int(available / used / 2)))
             self.logger.info("    memory used: {:,}M out of {:,}M".format(used, available))
 
-            if len(extra_elements) > 500000:
-                self.worker_threads = 1
             if self.worker_threads > 1:
-                self.logger.info("    running in multiprocessing mode with %d workers" % self.worker_threads)
+                # number of workers is controlled by memory governor
+                self.logger.info("    running in multiprocessing mode with up to %d workers" % self.worker_threads)
             else:
                 self.logger.info("    running in single threaded mode")
 
+            if self.dump_path:
+                self.logger.info("    saving elements to %s" % self.dump_path)
+                if self.basemap:
+                    dump_elements(self.dump_path, 0, 0, 0, elements)
+                else:
+                    dump_elements(self.dump_path, 7, x, y, elements)
+
             if self.interactive:
                 r = range(1, 8)
                 num_tiles = 0
@@ -820,24 +1147,41 @@ class MapWriter:
                 tile_queue = queue.Queue()
                 db_queue = queue.Queue()
 
+            if self.basemap:
+                tile = Tile(0, 0, 0, elements)
+            else:
+                tile = Tile(7, x, y, elements)
+
+            if self.worker_threads > 1:
+                # share elements with workers instead of sending them through the queue
+                with self.profile.stage('store'):
+                    self.store = ElementStore(elements, os.path.dirname(map_path), self.incremental)
+                self.logger.info("    stored {:,} elements ({:,}K of geometries)".format(len(self.store), self.store.offsets[-1] // 1024))
+                tile = self.store.job(tile)
+                del elements[:]
+                gc.collect()
+
+            stage_start = time.perf_counter()
             db_thread = threading.Thread(target=self.dbWorker, args=(db_queue,), name="{} db worker".format(self.proc_name))
             db_thread.start()
 
+            if self.subtree_zoom and self.worker_threads > 1:
+                self.idle_workers = multiprocessing.Value('i', 0)
+                self.logger.info("    generating subtrees from zoom %d" % self.subtree_zoom)
+
             processes = []
             if self.worker_threads > 1:
-                for i in range(self.worker_threads):
-                    p = multiprocessing.Process(target=self.tileWorker, args=(tile_queue, db_queue, True), name="{} tile worker {}".format(self.proc_name, i + 1))
+                def start_worker(index):
+                    p = multiprocessing.Process(target=self.tileWorker, args=(tile_queue, db_queue, True, index), name="{} tile worker {}".format(self.proc_name, index + 1))
                     p.start()
-                    processes.append(p)
+                    return p
+                self.governor = MemoryGovernor(start_worker, self.worker_threads, self.logger)
+                self.governor.start()
             else:
                 t = threading.Thread(target=self.tileWorker, args=(tile_queue, db_queue), name="{} tile worker".format(self.proc_name))
                 t.start()
                 processes.append(t)
 
-            if self.basemap:
-                tile = Tile(0, 0, 0, elements)
-            else:
-                tile = Tile(7, x, y, elements)
             tile_queue.put(tile)
 
             self.db.commit()
@@ -849,17 +1193,16 @@ class MapWriter:
                     if tile_queue.empty():
                         # block until all tasks are done
                         tile_queue.join()
-                        # stop workers
-                        for i in range(self.worker_threads):
-                            tile_queue.put(None)
-                        for p in processes:
-                            p.join()
+                        self.stopWorkers(tile_queue, processes)
                         timeout = 0
                         break
                     else:
                         time.sleep(1)  # just to avoid hogging the CPU
                 else:
                     self.logger.error("   timed out, killing all processes")
+                    if self.governor:
+                        processes = self.governor.stop()
+                        self.governor = None
                     for p in processes:
                         if p.is_alive():
                             if isinstance(p, multiprocessing.Process):
@@ -875,11 +1218,7 @@ class MapWriter:
             else:
                 # block until all tasks are done
                 tile_queue.join()
-                # stop workers
-                for i in range(self.worker_threads):
-                    tile_queue.put(None)
-                for p in processes:
-                    p.join()
+                self.stopWorkers(tile_queue, processes)
 
             # block until all tasks are done
             db_queue.join()
@@ -889,8 +1228,23 @@ class MapWriter:
             if self.worker_threads > 1:
                 tile_queue.close()
                 db_queue.close()
+            self.profile.add_stage('generate', time.perf_counter() - stage_start)
+
+            if self.dedup:
+                self.logger.info("    stored {:,} tiles as {:,} unique, dedup ratio {:.2f}".format(
+                    self.db.tile_count, self.db.blob_count, self.db.dedupRatio()))
+            with self.profile.stage('vacuum'):
+                self.db.finish()
+
+            if self.fingerprints:
+                self.fingerprints.finish()
+                self.fingerprints = None
+                self.fingerprint_salt = None
+                self.previous = None
 
-            self.db.finish()
+            if self.store:
+                self.store.close()
+                self.store = None
 
             if self.interactive:
                 self.gen_progress.close()
@@ -900,6 +1254,11 @@ class MapWriter:
             self.logger.info("    memory used: {:,}M out of {:,}M".format(used, available))
 
         elapsed_time = datetime.utcnow() - start_time
+        self.profile.save(self.profile_path(x, y), elapsed=round(elapsed_time.total_seconds(), 3))
+        self.logger.info("    stages: %s" % ", ".join("{} {:.1f}s".format(k, v) for k, v in self.profile.stages.items()))
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(self.cprofile_path)
         elapsed_time = elapsed_time - timedelta(microseconds=elapsed_time.microseconds)
         if has_elements and timeout:
             raise Exception("Timed out map: %s in %s (timeout was %s)" % (map_path, elapsed_time, timedelta(seconds=timeout)))
@@ -913,6 +1272,9 @@ class MapWriter:
         if self.db and not self.db.isValid():
             raise Exception("There was an error generating map %s, keeping old map file" % map_path)
 
+        if previous_aside:
+            os.remove(previous_aside)
+
         logging.getLogger().removeHandler(log_file_handler)
 
         # remove intermediate pbf file and log on success
@@ -921,6 +1283,7 @@ class MapWriter:
             os.remove(pbf_path)
             self.logger.debug("    removing log file %s", log_path)
             os.remove(log_path)
+            os.remove(self.profile_path(x, y))
 
         if has_elements:
             return map_path
@@ -933,30 +1296,229 @@ class MapWriter:
             if job is None:
                 db_queue.task_done()
                 break
-            self.db.putTile(job.zoom, job.x, job.y, job.features)
+            if isinstance(job, ProfileJob):
+                # counters of finished worker process
+                self.profile.merge(job.operations)
+                db_queue.task_done()
+                continue
+            with self.profile.measure(job.zoom, 'put'):
+                self.db.putTile(job.zoom, job.x, job.y, job.features)
+                if job.fingerprint is not None:
+                    self.fingerprints.put(job.zoom, job.x, job.y, job.fingerprint, content_hash(job.features))
             db_queue.task_done()
             if self.interactive:
                 self.gen_progress.update()
 
-    def tileWorker(self, tile_queue, db_queue, process=False):
+    def applyResults(self, elements, chunks, results):
+        """
+        applies results of element processing in element order and stores features, places are
+        stored after all elements are processed as overlapping places have to be merged first
+        """
+        places = []
+        for chunk, (kinds, types, areas, labels, buildings, hashes) in zip(chunks, results):
+            features = []
+            for i, index in enumerate(chunk):
+                el = elements[index]
+                el.kind = None if kinds[i] < 0 else int(kinds[i])
+                el.type = None if types[i] < 0 else int(types[i])
+                el.area = None if numpy.isnan(areas[i]) else float(areas[i])
+                el.label = decode_label(labels[i])
+                el.building = buildings[i]
+                if el.id and is_place(el.kind):
+                    places.append(el)
+                else:
+                    features.append(el)
+            self.storeFeatures(features)
+            if hashes:
+                self.labels.put([(h, labels[i]) for i, h in enumerate(hashes) if h is not None])
+            if self.interactive:
+                self.proc_progress.update(len(chunk))
+        merged = merge_places(places)
+        if merged:
+            self.logger.debug("     merged %d places", merged)
+        self.storeFeatures(places)
+
+    def storeFeatures(self, elements):
+        """
+        transforms elements to points if required and saves features for future reference
+        """
+        positions = []
+        for el in elements:
+            if 'transform' in el.mapping:
+                if el.mapping.get('transform') == 'point' and el.geom.type != 'Point':
+                    if el.label:
+                        if isinstance(el.label, list):
+                            el.geom = el.label[0]
+                        else:
+                            el.geom = el.label
+                    else:
+                        el.geom = el.geom.representative_point()
+
+            # if feature has type or name save it for future reference
+            if el.type or 'name' in el.tags:
+                positions.append(el)
+        if not positions:
+            return
+        # feature positions are converted to WGS84 at once
+        points = [(el.label[0] if isinstance(el.label, list) else el.label) if el.label else el.geom for el in positions]
+        points = [point if point.type == 'Point' else None for point in points]
+        lons, lats = points_to_wgs84([point for point in points if point is not None])
+        j = 0
+        for el, point in zip(positions, points):
+            if point is not None:
+                position = (float(lons[j]), float(lats[j]))
+                j += 1
+            else:
+                position = None
+            self.db.putFeature(el.id, el.tags, el.kind, el.type, el.label, el.geom, position)
+            el.tags.pop('name:en', None)
+            el.tags.pop('name:de', None)
+            el.tags.pop('name:ru', None)
+            el.tags.pop('opening_hours', None)
+            el.tags.pop('website', None)
+            el.tags.pop('phone', None)
+            el.tags.pop('wikipedia', None)
+            el.tags['id'] = el.id
+
+    def fetchElements(self, connection, sql, emit):
+        """
+        fetches element query results in batches, binary copy passes geometry to filter as raw WKB
+        """
+        if self.binary_copy:
+            copy = "COPY (SELECT ST_AsBinary(wkb), id::bigint, tags, names FROM ({}) AS q) TO STDOUT (FORMAT binary)".format(sql)
+            batch = []
+
+            def add(row):
+                batch.append(CopyRow(*row))
+                if len(batch) >= FETCH_BATCH:
+                    emit(batch[:])
+                    batch.clear()
+
+            parser = BinaryCopyParser((decode_bytea, decode_int8, decode_hstore, decode_hstore), add)
+            with connection.cursor() as cur:
+                self.logger.debug("   %s", copy)
+                cur.copy_expert(copy, parser)
+            if batch:
+                emit(batch)
+        else:
+            with connection.cursor('large') as cur:
+                cur.itersize = FETCH_BATCH
+                cur.execute(sql)
+                self.logger.debug("   %s", cur.query.decode())
+                while True:
+                    rows = cur.fetchmany(FETCH_BATCH)
+                    if not rows:
+                        break
+                    emit(rows)
+
+    def fetchSupplementary(self, connection, sql, emit):
+        with connection.cursor('supplementary', cursor_factory=psycopg2.extras.DictCursor) as cur:
+            cur.itersize = FETCH_BATCH
+            cur.execute(sql)
+            self.logger.debug("     %s", cur.query.decode())
+            while True:
+                rows = cur.fetchmany(FETCH_BATCH)
+                if not rows:
+                    break
+                emit(rows)
+
+    def stopWorkers(self, tile_queue, processes):
+        if self.governor:
+            processes = self.governor.stop()
+            self.governor = None
+        for p in processes:
+            tile_queue.put(None)
+        for p in processes:
+            p.join()
+
+    def tileWorker(self, tile_queue, db_queue, process=False, index=0):
+        profiler = None
         if process:
             setproctitle.setproctitle(multiprocessing.current_process().name)
+            # worker process collects its own counters and passes them to main process on exit
+            self.profile = Profile()
+        if self.cprofile_path:
+            # profiler has to be enabled in each thread
+            profiler = cProfile.Profile()
+            profiler.enable()
         self.tile_queue = tile_queue
         self.db_queue = db_queue
+        if self.subtree_zoom:
+            self.local_tiles = deque()
         while True:
-            tile = tile_queue.get()
-            if tile is None:
-                tile_queue.task_done()
+            # worker can be retired by memory governor
+            retired = self.governor is not None and not self.governor.admit(index)
+            if not retired:
+                if self.idle_workers:
+                    with self.idle_workers.get_lock():
+                        self.idle_workers.value += 1
+                tile = tile_queue.get()
+                if self.idle_workers:
+                    with self.idle_workers.get_lock():
+                        self.idle_workers.value -= 1
+            if retired or tile is None:
+                if process:
+                    db_queue.put(ProfileJob(self.profile.operations))
+                if profiler:
+                    profiler.disable()
+                    profiler.dump_stats("{}.{}".format(self.cprofile_path, os.getpid() if process else 'tiles'))
+                if not retired:
+                    tile_queue.task_done()
                 break
             # noinspection PyBroadException
             try:
+                if isinstance(tile, TileJob):
+                    tile = Tile(tile.zoom, tile.x, tile.y, self.store.elements(tile), set(tile.clipped))
                 self.generateTile(tile)
             except Exception:
-                self.logger.exception("Error generating tile %s" % tile)
+                self.logger.exception("Error generating tile %d/%d/%d" % (tile.zoom, tile.x, tile.y))
+            if self.local_tiles is not None:
+                self.generateSubtree()
             tile_queue.task_done()
 
+    def generateSubtree(self):
+        """
+        generates locally queued tiles depth first, shares upper pending tiles with idle workers
+        """
+        while self.local_tiles:
+            if self.idle_workers and self.idle_workers.value > 0 and len(self.local_tiles) > 1 and self.tile_queue.empty():
+                self.queueTile(self.local_tiles.popleft())
+                continue
+            tile = self.local_tiles.pop()
+            # noinspection PyBroadException
+            try:
+                self.generateTile(tile)
+            except Exception:
+                self.logger.exception("Error generating tile %s" % tile)
+
+    def queueTile(self, tile):
+        if self.store:
+            self.tile_queue.put(self.store.job(tile))
+        else:
+            self.tile_queue.put(tile)
+
     def generateTile(self, tile):
+        with self.profile.measure(tile.zoom, 'tile'):
+            self.generateTileFeatures(tile)
+
+        # propagate elements to lower zoom
+        if (not self.basemap and tile.zoom < 14) or tile.zoom < 7:
+            with self.profile.measure(tile.zoom, 'split'):
+                self.generateSubtiles(tile)
+
+    def generateTileFeatures(self, tile):
         if (self.basemap and tile.zoom > 0) or tile.zoom > 7:
+            fingerprint = None
+            if self.fingerprint_salt:
+                with self.profile.measure(tile.zoom, 'fingerprint'):
+                    fingerprint = tile_fingerprint(self.fingerprint_salt, tile)
+                if self.previous:
+                    content = self.previous.getTile(tile.zoom, tile.x, tile.y, fingerprint)
+                    if content is not None:
+                        self.profile.add(tile.zoom, 'reuse', 0.0)
+                        self.db_queue.put(DBJob(tile.zoom, tile.x, tile.y, content, fingerprint))
+                        return
+
             if len(tile.elements) > 0:
                 self.logger.debug("    generating tile %s with %d elements" % (tile, len(tile.elements)))
 
@@ -980,74 +1542,69 @@ class MapWriter:
                         self.logger.error("Failed to dissolve building parts in tile %s" % tile)
                         building_parts_geom = None
 
-            for element in tile.elements:
-                if element.mapping.get('zoom-min', 0) > tile.zoom:
-                    continue
-                geom = element.geom
-                united = 'union' in element.mapping and tile.zoom <= element.mapping.get('union-zoom-max', 14) \
-                         and geom.type in ['LineString', 'MultiLineString', 'Polygon', 'MultiPolygon']
-                if tile.zoom < 14:
-                    if element.area:
-                        pixel_area = element.area / tile_ground_square_scale
-                        if self.basemap and 'basemap-filter-area' in element.mapping:
-                            area = (element.mapping.get('basemap-filter-area', 0) * (2 << tile.zoom)) ** 2
-                        else:
-                            area = element.mapping.get('filter-area', 1)
-                        if pixel_area < area:
-                            continue
-                    if 'buffer' in element.mapping:
-                        geom = geom.buffer(tile.pixelWidth * element.mapping.get('buffer', 1))
-                    if not united:
-                        simple_geom = geom.simplify(tile.pixelWidth * element.mapping.get('simplify', 1))
-                        if simple_geom.is_valid:
-                            geom = simple_geom
-                        if geom.type in ['LineString', 'MultiLineString']:
-                            # todo: it's a quick hack, replace with bounding box analysis
-                            if geom.length < tile.pixelWidth:
+            if self.vectorized and len(tile.elements) >= VECTORIZED_MIN_ELEMENTS:
+                self.generateFeatures(tile, features, unions, merges, prepared_clip, building_parts_geom, building_parts_prepared)
+            else:
+                for element in tile.elements:
+                    if element.mapping.get('zoom-min', 0) > tile.zoom:
+                        continue
+                    geom = element.geom
+                    united = 'union' in element.mapping and tile.zoom <= element.mapping.get('union-zoom-max', 14) \
+                             and geom.type in ['LineString', 'MultiLineString', 'Polygon', 'MultiPolygon']
+                    if tile.zoom < 14:
+                        if element.area:
+                            pixel_area = element.area / tile_ground_square_scale
+                            if self.basemap and 'basemap-filter-area' in element.mapping:
+                                area = (element.mapping.get('basemap-filter-area', 0) * (2 << tile.zoom)) ** 2
+                            else:
+                                area = element.mapping.get('filter-area', 1)
+                            if pixel_area < area:
                                 continue
-                else:
-                    if 'enlarge' in element.mapping:
-                        geom = geom.buffer(tile.pixelWidth * element.mapping.get('enlarge', 1))
-                    if 'building' in element.tags and 'building:outline' not in element.tags and 'building:part' not in element.tags:
-                        # if building_parts_geom is None or not building_parts_prepared.intersects(element.geom) or building_parts_geom.intersection(element.geom).area == 0:
-                        if building_parts_geom is None or not building_parts_prepared.covers(element.geom):
-                            element.tags['building:part'] = element.tags['building']
-                if united:
-                    if type(element.mapping['union']) is dict:
-                        pattern = [k for k, v in element.mapping['union'].items() if tile.zoom >= v]
+                        if 'buffer' in element.mapping:
+                            geom = geom.buffer(tile.pixelWidth * element.mapping.get('buffer', 1))
+                        if not united:
+                            with self.profile.measure(tile.zoom, 'simplify'):
+                                simple_geom = geom.simplify(tile.pixelWidth * element.mapping.get('simplify', 1))
+                            if simple_geom.is_valid:
+                                geom = simple_geom
+                            if geom.type in ['LineString', 'MultiLineString']:
+                                # todo: it's a quick hack, replace with bounding box analysis
+                                if geom.length < tile.pixelWidth:
+                                    continue
                     else:
-                        pattern = [x.strip() for x in element.mapping['union'].split(',')]
-                    values = [element.tags[k] for k in sorted(set(pattern) & set(element.tags.keys()))]
-                    key = hash(tuple(values))
-                    if len(values):
-                        element.geometry = geom
-                        if geom.type in ['LineString', 'MultiLineString']:
-                            merges[key].append(element)
+                        if 'enlarge' in element.mapping:
+                            geom = geom.buffer(tile.pixelWidth * element.mapping.get('enlarge', 1))
+                        if 'building' in element.tags and 'building:outline' not in element.tags and 'building:part' not in element.tags:
+                            # if building_parts_geom is None or not building_parts_prepared.intersects(element.geom) or building_parts_geom.intersection(element.geom).area == 0:
+                            if building_parts_geom is None or not building_parts_prepared.covers(element.geom):
+                                element.tags['building:part'] = element.tags['building']
+                    if united:
+                        if type(element.mapping['union']) is dict:
+                            pattern = [k for k, v in element.mapping['union'].items() if tile.zoom >= v]
                         else:
-                            unions[key].append(element)
+                            pattern = [x.strip() for x in element.mapping['union'].split(',')]
+                        values = [element.tags[k] for k in sorted(set(pattern) & set(element.tags.keys()))]
+                        key = hash(tuple(values))
+                        if len(values):
+                            element.geometry = geom
+                            if geom.type in ['LineString', 'MultiLineString']:
+                                merges[key].append(element)
+                            else:
+                                unions[key].append(element)
+                            continue
+                        else:
+                            self.logger.warning("Empty union key for %s, pattern: %s" % (element.osm_id(), pattern))
+                    if tile.zoom < 14:
+                        if 'transform' in element.mapping:
+                            if element.mapping.get('transform') == 'filter-rings':
+                                geom = filter_rings(geom, tile_pixel_area)
+                        if 'buffer' in element.mapping:
+                            geom = geom.buffer(tile.pixelWidth * -element.mapping.get('buffer', 1))
+                    geometry = affine_transform(geom, tile.matrix)
+                    if geometry.is_empty:
                         continue
-                    else:
-                        self.logger.warning("Empty union key for %s, pattern: %s" % (element.osm_id(), pattern))
-                if tile.zoom < 14:
-                    if 'transform' in element.mapping:
-                        if element.mapping.get('transform') == 'filter-rings':
-                            geom = filter_rings(geom, tile_pixel_area)
-                    if 'buffer' in element.mapping:
-                        geom = geom.buffer(tile.pixelWidth * -element.mapping.get('buffer', 1))
-                geometry = affine_transform(geom, tile.matrix)
-                if geometry.is_empty:
-                    continue
-                labels = None
-                if element.label:
-                    if isinstance(element.label, list):
-                        for label in element.label:
-                            if prepared_clip.contains(label):
-                                if labels is None:
-                                    labels = []
-                                labels.append(affine_transform(label, tile.matrix))
-                    elif prepared_clip.contains(element.label):
-                        labels = affine_transform(element.label, tile.matrix)
-                features.append(Feature(element.id, geometry, element.area, element.tags, element.kind, element.type, labels, element.building))
+                    labels = self.tileLabels(tile, element, prepared_clip)
+                    features.append(Feature(element.id, geometry, element.area, element.tags, element.kind, element.type, labels, element.building))
 
             # TODO combine union and merge to one logical block
             for union in unions:
@@ -1055,7 +1612,8 @@ class MapWriter:
                 # noinspection PyBroadException
                 try:
                     # create united geometry
-                    united_geom = cascaded_union([el.geometry for el in unions[union]])
+                    with self.profile.measure(tile.zoom, 'union', len(unions[union])):
+                        united_geom = cascaded_union([el.geometry for el in unions[union]])
                     if type(first.mapping['union']) is dict:
                         pattern = [k for k, v in first.mapping['union'].items() if tile.zoom >= v]
                     else:
@@ -1094,7 +1652,8 @@ class MapWriter:
                             lines.append(el.geometry)
                         else:
                             lines.extend(el.geometry.geoms)
-                    united_geom = linemerge(lines)
+                    with self.profile.measure(tile.zoom, 'linemerge', len(lines)):
+                        united_geom = linemerge(lines)
                     # simplify after merge
                     united_geom = united_geom.simplify(tile.pixelWidth)
                     # remove too short segments
@@ -1116,38 +1675,170 @@ class MapWriter:
                 except Exception:
                     self.logger.error("Failed to process merge %s in tile %s" % (first.mapping['union'], tile))
 
-            encoded = encode(features, mappings.tags)
-            self.db_queue.put(DBJob(tile.zoom, tile.x, tile.y, encoded))
-
-        # propagate elements to lower zoom
-        if (not self.basemap and tile.zoom < 14) or tile.zoom < 7:
-            nx = tile.x << 1
-            ny = tile.y << 1
-            nz = tile.zoom + 1
-            self.generateSubtiles(nx, ny, nz, tile)
-            self.generateSubtiles(nx, ny + 1, nz, tile)
-            self.generateSubtiles(nx + 1, ny, nz, tile)
-            self.generateSubtiles(nx + 1, ny + 1, nz, tile)
-
-    def generateSubtiles(self, x, y, zoom, tile):
-        subtile = Tile(zoom, x, y)
-        # https://stackoverflow.com/a/43105613/488489 - indexing
-        prepared_clip = prep(subtile.bbox.buffer(1.194 * 4))
-        clipCache = BBoxCache(subtile)
+            with self.profile.measure(tile.zoom, 'encode'):
+                encoded = encode(features, mappings.tags)
+            self.db_queue.put(DBJob(tile.zoom, tile.x, tile.y, encoded, fingerprint))
+
+    def tileLabels(self, tile, element, prepared_clip):
+        labels = None
+        if element.label:
+            if isinstance(element.label, list):
+                for label in element.label:
+                    if prepared_clip.contains(label):
+                        if labels is None:
+                            labels = []
+                        labels.append(affine_transform(label, tile.matrix))
+            elif prepared_clip.contains(element.label):
+                labels = affine_transform(element.label, tile.matrix)
+        return labels
+
+    def generateFeatures(self, tile, features, unions, merges, prepared_clip, building_parts_geom, building_parts_prepared):
+        """
+        vectorized variant of tile element processing, geometry operations are applied to all tile elements at once
+        """
+        tile_pixel_area = tile.pixelWidth * tile.pixelWidth
+        tile_ground_square_scale = tile.groundScale ** 2
+        candidates = []
+        keys = []
         for element in tile.elements:
-            if element.mapping.get('zoom-max', 14) < zoom:
+            if element.mapping.get('zoom-min', 0) > tile.zoom:
                 continue
-            # noinspection PyBroadException
-            try:
-                if prepared_clip.covers(element.geom):
+            united = 'union' in element.mapping and tile.zoom <= element.mapping.get('union-zoom-max', 14) \
+                and element.geom.type in ['LineString', 'MultiLineString', 'Polygon', 'MultiPolygon']
+            if tile.zoom < 14:
+                if element.area:
+                    pixel_area = element.area / tile_ground_square_scale
+                    if self.basemap and 'basemap-filter-area' in element.mapping:
+                        area = (element.mapping.get('basemap-filter-area', 0) * (2 << tile.zoom)) ** 2
+                    else:
+                        area = element.mapping.get('filter-area', 1)
+                    if pixel_area < area:
+                        continue
+            else:
+                if 'building' in element.tags and 'building:outline' not in element.tags and 'building:part' not in element.tags:
+                    if building_parts_geom is None or not building_parts_prepared.covers(element.geom):
+                        element.tags['building:part'] = element.tags['building']
+            key = None
+            if united:
+                if type(element.mapping['union']) is dict:
+                    pattern = [k for k, v in element.mapping['union'].items() if tile.zoom >= v]
+                else:
+                    pattern = [x.strip() for x in element.mapping['union'].split(',')]
+                values = [element.tags[k] for k in sorted(set(pattern) & set(element.tags.keys()))]
+                if len(values):
+                    key = hash(tuple(values))
+                else:
+                    self.logger.warning("Empty union key for %s, pattern: %s" % (element.osm_id(), pattern))
+            candidates.append((element, united, key))
+        if not candidates:
+            return
+
+        geoms = numpy.array([element.geom for element, _, _ in candidates], dtype=object)
+        united = numpy.array([u for _, u, _ in candidates], dtype=bool)
+        keep = numpy.ones(len(candidates), dtype=bool)
+        if tile.zoom < 14:
+            factors = numpy.array([element.mapping.get('buffer', 1) if 'buffer' in element.mapping else numpy.nan
+                                   for element, _, _ in candidates])
+            buffered = ~numpy.isnan(factors)
+            if buffered.any():
+                geoms[buffered] = shapely.buffer(geoms[buffered], tile.pixelWidth * factors[buffered], quad_segs=16)
+            simplified = ~united
+            if simplified.any():
+                tolerance = numpy.array([element.mapping.get('simplify', 1) for element, _, _ in candidates])
+                with self.profile.measure(tile.zoom, 'simplify', int(numpy.count_nonzero(simplified))):
+                    simple_geoms = shapely.simplify(geoms[simplified], tile.pixelWidth * tolerance[simplified])
+                valid = shapely.is_valid(simple_geoms)
+                indices = numpy.flatnonzero(simplified)
+                geoms[indices[valid]] = simple_geoms[valid]
+                # todo: it's a quick hack, replace with bounding box analysis
+                lines = numpy.isin(shapely.get_type_id(geoms), (1, 5))  # LineString, MultiLineString
+                keep &= ~(simplified & lines & (shapely.length(geoms) < tile.pixelWidth))
+        else:
+            factors = numpy.array([element.mapping.get('enlarge', 1) if 'enlarge' in element.mapping else numpy.nan
+                                   for element, _, _ in candidates])
+            enlarged = ~numpy.isnan(factors)
+            if enlarged.any():
+                geoms[enlarged] = shapely.buffer(geoms[enlarged], tile.pixelWidth * factors[enlarged], quad_segs=16)
+
+        lines = numpy.isin(shapely.get_type_id(geoms), (1, 5))
+        featured = numpy.zeros(len(candidates), dtype=bool)
+        for idx in numpy.flatnonzero(keep):
+            element, _, key = candidates[idx]
+            if key is not None:
+                element.geometry = geoms[idx]
+                if lines[idx]:
+                    merges[key].append(element)
+                else:
+                    unions[key].append(element)
+            else:
+                featured[idx] = True
+                if tile.zoom < 14 and element.mapping.get('transform', None) == 'filter-rings':
+                    geoms[idx] = filter_rings(geoms[idx], tile_pixel_area)
+        if not featured.any():
+            return
+
+        if tile.zoom < 14:
+            factors = numpy.array([element.mapping.get('buffer', 1) if 'buffer' in element.mapping else numpy.nan
+                                   for element, _, _ in candidates])
+            buffered = featured & ~numpy.isnan(factors)
+            if buffered.any():
+                geoms[buffered] = shapely.buffer(geoms[buffered], tile.pixelWidth * -factors[buffered], quad_segs=16)
+        matrix = numpy.array([[tile.matrix[0], tile.matrix[1]], [tile.matrix[2], tile.matrix[3]]])
+        offset = numpy.array([tile.matrix[4], tile.matrix[5]])
+        geometries = shapely.transform(geoms[featured], lambda coords: numpy.matmul(matrix, coords.T).T + offset)
+        empty = shapely.is_empty(geometries)
+        for geometry, is_empty, idx in zip(geometries, empty, numpy.flatnonzero(featured)):
+            if is_empty:
+                continue
+            element = candidates[idx][0]
+            labels = self.tileLabels(tile, element, prepared_clip)
+            features.append(Feature(element.id, geometry, element.area, element.tags, element.kind, element.type, labels, element.building))
+
+    def generateSubtiles(self, tile):
+        nx = tile.x << 1
+        ny = tile.y << 1
+        nz = tile.zoom + 1
+        subtiles = [Tile(nz, nx, ny), Tile(nz, nx, ny + 1), Tile(nz, nx + 1, ny), Tile(nz, nx + 1, ny + 1)]
+        elements = [element for element in tile.elements if element.mapping.get('zoom-max', 14) >= nz]
+        # split elements by their bounding boxes, exact predicates are checked only for those crossing tile border
+        bounds = geometry_bounds([element.geom for element in elements])
+        left, bottom, right, top = bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]
+        expand = 1.194 * 4
+        for subtile in subtiles:
+            sb = subtile.bounds
+            with numpy.errstate(invalid='ignore'):
+                inside = (left >= sb.left) & (bottom >= sb.bottom) & (right <= sb.right) & (top <= sb.top)
+                near = (left <= sb.right + expand) & (bottom <= sb.top + expand) \
+                    & (right >= sb.left - expand) & (top >= sb.bottom - expand)
+            prepared_clip = None
+            clipCache = BBoxCache(subtile)
+            for idx in numpy.flatnonzero(near):
+                element = elements[idx]
+                # noinspection PyBroadException
+                try:
+                    if not inside[idx]:
+                        if prepared_clip is None:
+                            # https://stackoverflow.com/a/43105613/488489 - indexing
+                            prepared_clip = prep(subtile.bbox.buffer(expand))
+                        if not prepared_clip.covers(element.geom):
+                            if prepared_clip.intersects(element.geom):
+                                with self.profile.measure(nz, 'clip'):
+                                    clipped = element.clone(clipCache[element.mapping.get('clip-buffer', 4)].intersection(element.geom))
+                                subtile.elements.append(clipped)
+                                if self.store:
+                                    subtile.clipped.add(clipped.index)
+                            continue
                     subtile.elements.append(element)
-                elif prepared_clip.intersects(element.geom):
-                    subtile.elements.append(element.clone(clipCache[element.mapping.get('clip-buffer', 4)].intersection(element.geom)))
-            except Exception as ex:
-                self.logger.error("Error preparing element for tile %s" % subtile)
-                self.logger.error(" element was: %s" % element)
-                self.logger.error(" error was: %s" % ex)
-        self.tile_queue.put(subtile)
+                    if element.index in tile.clipped:
+                        subtile.clipped.add(element.index)
+                except Exception as ex:
+                    self.logger.error("Error preparing element for tile %s" % subtile)
+                    self.logger.error(" element was: %s" % element)
+                    self.logger.error(" error was: %s" % ex)
+            if self.local_tiles is not None and nz > self.subtree_zoom:
+                self.local_tiles.append(subtile)
+            else:
+                self.queueTile(subtile)
 
     def generateIntermediateFile(self, source_pbf_path, x, y, z, name):
         ax = x >> (7 - z)
@@ -1235,6 +1926,24 @@ class MapWriter:
         """
         return self.map_path_base(x, y) + ".log"
 
+    def fingerprints_path(self, x, y):
+        """
+        returns path to tile fingerprints file
+        """
+        return self.map_path_base(x, y) + ".fingerprints"
+
+    def labels_path(self, x, y):
+        """
+        returns path to building labels file
+        """
+        return self.map_path_base(x, y) + ".labels"
+
+    def profile_path(self, x, y):
+        """
+        returns path to profiling summary file
+        """
+        return self.map_path_base(x, y) + ".profile.json"
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='MapTrek map writer')
@@ -1245,6 +1954,15 @@ if __name__ == "__main__":
     parser.add_argument('-l', '--log', default='ERROR', help='set logging verbosity')
     parser.add_argument('-n', '--noninteractive', action='store_true', help='forbid interactive mode')
     parser.add_argument('-s', '--single-thread', action='store_true', help='do not use multi-threading')
+    parser.add_argument('-c', '--filter-cache', default=0, type=int, help='size of tag filter cache (0 - disabled)')
+    parser.add_argument('-z', '--subtree-zoom', default=0, type=int, help='generate tiles below this zoom within one worker (0 - disabled)')
+    parser.add_argument('--vectorized', action='store_true', help='use vectorized geometry processing (requires Shapely 2.0+)')
+    parser.add_argument('--dump-elements', help='save processed elements to file (for benchmarking)')
+    parser.add_argument('--cprofile', action='store_true', help='save cProfile statistics next to log file')
+    parser.add_argument('--dedup', action='store_true', help='store identical tiles once')
+    parser.add_argument('--incremental', action='store_true', help='reuse tiles of previous map which input has not changed')
+    parser.add_argument('--previous', help='previous map file (default: existing map file)')
+    parser.add_argument('--binary-copy', action='store_true', help='read elements from database with binary COPY')
     parser.add_argument('-i', '--intermediate', action='store_true', help='create intermediate osm.pbf file')
     parser.add_argument('-k', '--keep', action='store_true', help='do not remove intermediate osm.pbf file on success')
     parser.add_argument('-f', '--from-file', action='store_true', help='use file instead of database as data source')
@@ -1265,7 +1983,9 @@ if __name__ == "__main__":
         app_logger.setLevel(logging.DEBUG)
 
     try:
-        mapWriter = MapWriter(args.data_path, args.dry_run, args.noninteractive, args.single_thread)
-        mapWriter.createMap(args.x, args.y, args.timeout, args.intermediate, args.keep, args.from_file, args.bbox)
+        mapWriter = MapWriter(args.data_path, args.dry_run, args.noninteractive, args.single_thread, args.filter_cache,
+                              args.subtree_zoom, args.vectorized, args.dump_elements, args.cprofile, args.dedup, args.incremental,
+                              args.binary_copy)
+        mapWriter.createMap(args.x, args.y, args.timeout, args.intermediate, args.keep, args.from_file, args.bbox, args.previous)
     except Exception as e:
         app_logger.exception(e)
@@ -10,10 +10,10 @@ import psycopg2.extras
 import osmium
 import shapely.wkb as shapely_wkb
 from shapely.geometry.base import BaseGeometry
-from shapely.ops import transform, linemerge
+from shapely.ops import linemerge
 
 import configuration
-from util.geometry import wgs84_to_mercator
+from util.projection import geometry_to_mercator
 from util.osm.buildings import get_color
 
 wkbFactory = osmium.geom.WKBFactory()
@@ -119,7 +119,7 @@ class OsmFilter(osmium.SimpleHandler):
             if route:
                 if route not in ('bicycle', 'mtb'):
                     colour = None
-                geom = transform(wgs84_to_mercator, shapely_wkb.loads(wkb, hex=True))
+                geom = geometry_to_mercator(shapely_wkb.loads(wkb, hex=True))
                 element_id = (w.id << 2) + 2
                 self.routes[element_id] = Route(geom, route, next(iter(network.keys()), None), osmc_symbol, colour, state, ref, name, name_en, name_de, name_ru, way)
             else:
@@ -186,7 +186,7 @@ class OsmFilter(osmium.SimpleHandler):
                     if way['closed']:
                         continue
                     if way['wkb']:
-                        geom: BaseGeometry = transform(wgs84_to_mercator, shapely_wkb.loads(way['wkb'], hex=True))
+                        geom: BaseGeometry = geometry_to_mercator(shapely_wkb.loads(way['wkb'], hex=True))
                         relation.geoms.append(geom)
                         relation.ways.append(member.ref)
                     else:
@@ -2,6 +2,7 @@ CREATE TABLE maps (
     area character varying(7) NOT NULL,
     size integer DEFAULT 0 NOT NULL,
     cost integer DEFAULT 0 NOT NULL,
+    profile jsonb,
     created integer DEFAULT 0 NOT NULL,
     error boolean DEFAULT false NOT NULL
 );
@@ -22,6 +23,14 @@ ALTER TABLE ONLY map_downloads
 
 CREATE INDEX map_downloads_month ON map_downloads USING btree (month);
 
+CREATE TABLE map_changes (
+    area character varying(7) NOT NULL,
+    changes integer DEFAULT 0 NOT NULL
+);
+
+ALTER TABLE ONLY map_changes
+    ADD CONSTRAINT map_changes_pkey PRIMARY KEY (area);
+
 CREATE OR REPLACE FUNCTION popular_map(percent real, period interval) RETURNS TABLE(area text, created date)
 AS $$
   SELECT * FROM (
@@ -40,6 +49,24 @@ AS $$
 $$
 LANGUAGE SQL STABLE STRICT;
 
+CREATE OR REPLACE FUNCTION changed_map(period interval) RETURNS TABLE(area text, created date)
+AS $$
+  SELECT area, created FROM (
+    SELECT maps.area, (date '1970-01-01' + created * interval '1 day')::date AS created,
+      map_changes.changes * (1 + COALESCE(areas.downloads, 0)) AS score FROM map_changes
+    INNER JOIN maps ON (map_changes.area = maps.area)
+    LEFT JOIN (
+      SELECT area, SUM(downloads) AS downloads FROM map_downloads
+      WHERE month >= (date_part('year', now() - interval '2 months') * 100 + date_part('month', now() - interval '2 months'))::integer
+      GROUP BY area
+    ) AS areas ON (map_changes.area = areas.area)
+    WHERE map_changes.changes > 0 AND error = FALSE
+  ) AS areas
+  WHERE age(created) > $1
+  ORDER BY score DESC
+$$
+LANGUAGE SQL STABLE STRICT;
+
 CREATE OR REPLACE FUNCTION downloaded_map(period interval) RETURNS TABLE(area text, created date)
 AS $$
   SELECT * FROM (
@@ -0,0 +1,3 @@
+-- Brings existing stats databases up to date with schema.sql, safe to run repeatedly
+
+ALTER TABLE maps ADD COLUMN IF NOT EXISTS profile jsonb;
@@ -0,0 +1,106 @@
+import random
+import struct
+
+import pytest
+
+from util.pgcopy import BinaryCopyParser, COPY_SIGNATURE, decode_bytea, decode_int8, decode_hstore
+
+
+def field(data):
+    return struct.pack('!i', len(data)) + data
+
+
+def null():
+    return struct.pack('!i', -1)
+
+
+def hstore(tags):
+    data = struct.pack('!i', len(tags))
+    for k, v in tags.items():
+        data += field(k.encode())
+        data += null() if v is None else field(v.encode())
+    return field(data)
+
+
+def copy_stream(rows, extension=b''):
+    """
+    Builds binary COPY stream of (bytea, int8, hstore, hstore) rows, None fields are NULL
+    """
+    stream = COPY_SIGNATURE + struct.pack('!i', 0) + struct.pack('!i', len(extension)) + extension
+    for data, number, tags, names in rows:
+        stream += struct.pack('!h', 4)
+        stream += null() if data is None else field(data)
+        stream += null() if number is None else field(struct.pack('!q', number))
+        stream += null() if tags is None else hstore(tags)
+        stream += null() if names is None else hstore(names)
+    return stream + struct.pack('!h', -1)
+
+
+# int8 values exceed 32 bits and have both signs
+ROWS = [(bytes(range(i % 50)), (-1) ** i * (i << 40), {'amenity': 'cafe', 'name': 'Кафе %d' % i},
+         {'en': 'Cafe'} if i % 2 else None) for i in range(1, 300)]
+ROWS += [
+    (b'', 0, {}, {}),  # empty bytea and empty hstore
+    (None, None, None, None),  # all fields are NULL
+    (b'\x01', -1, {'highway': 'primary', 'note': None}, None),  # NULL hstore value
+]
+
+
+def parse(stream, chunk_sizes):
+    rows = []
+    parser = BinaryCopyParser((decode_bytea, decode_int8, decode_hstore, decode_hstore), rows.append)
+    position = 0
+    for size in chunk_sizes:
+        if position >= len(stream):
+            break
+        parser.write(stream[position:position + size])
+        position += size
+    return parser, rows
+
+
+def expected(rows):
+    return [list(row) for row in rows]
+
+
+def test_single_write():
+    stream = copy_stream(ROWS)
+    parser, rows = parse(stream, [len(stream)])
+    assert parser.finished and parser.count == len(ROWS) and not parser.buffer
+    assert rows == expected(ROWS)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_multi_chunk_writes(seed):
+    stream = copy_stream(ROWS)
+    rnd = random.Random(seed)
+    parser, rows = parse(stream, iter(lambda: rnd.randint(1, 300), None))
+    assert parser.finished and parser.count == len(ROWS) and not parser.buffer
+    assert rows == expected(ROWS)
+
+
+def test_byte_by_byte_with_header_extension():
+    stream = copy_stream(ROWS[:5], extension=b'\x00\x01\x02')
+    parser, rows = parse(stream, [1] * len(stream))
+    assert parser.finished
+    assert rows == expected(ROWS[:5])
+
+
+def test_invalid_signature():
+    stream = copy_stream(ROWS[:1])
+    parser = BinaryCopyParser((decode_bytea, decode_int8, decode_hstore, decode_hstore), lambda row: None)
+    with pytest.raises(ValueError):
+        parser.write(b'NOTCOPY' + stream[7:])
+
+
+def test_unexpected_field_count():
+    stream = copy_stream(ROWS[:1])
+    parser = BinaryCopyParser((decode_bytea, decode_int8), lambda row: None)
+    with pytest.raises(ValueError):
+        parser.write(stream)
+
+
+def test_decoders():
+    assert decode_bytea(memoryview(b'abc')) == b'abc'
+    assert decode_int8(struct.pack('!q', -5)) == -5
+    assert decode_hstore(struct.pack('!i', 0)) == {}
+    assert decode_hstore(hstore({'name': 'Имя', 'x': None})[4:]) == {'name': 'Имя', 'x': None}
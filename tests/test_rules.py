@@ -0,0 +1,181 @@
+import os
+import json
+import logging
+
+import pytest
+
+import mappings
+from mapwrite import OsmFilter
+
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'tag_corpus.json')
+
+
+def load_corpus():
+    with open(CORPUS_PATH) as f:
+        return [dict(tags) for tags in json.load(f)]
+
+
+def legacy_filter(tags, basemap):
+    """
+    Mapping walk as it was before rule table was introduced, returns renderable flag, filtered tags, mapping,
+    ignorable flag and pre-processors. The only change is that union dictionary is copied before combining,
+    original code modified shared mapping definitions.
+    """
+    filtered_tags = {}
+    mapping = {}
+    renderable = False
+    ignorable = True
+    modifiers = set()
+    processors = set()
+    for key, value in tags.items():
+        key = key.strip().lower()
+        if key in mappings.tags:
+            m = mappings.tags[key].get('__any__', None)
+            if m is None:
+                m = mappings.tags[key].get(value, None)
+            if m is not None:  # empty dictionaries should be also accounted
+                if 'rewrite-key' in m or 'rewrite-value' in m:
+                    key = m.get('rewrite-key', key)
+                    if m.get('rewrite-if-missing', False) and filtered_tags.get(key, None):
+                        continue
+                    value = m.get('rewrite-value', value)
+                    if 'add-tags' in m and 'rewrite-key' in m:  # preserve original setting
+                        add = mapping.get('add-tags', {})
+                        mapping['add-tags'] = {**add, **m['add-tags']}
+                    if 'keep-for' in m and 'rewrite-key' in m:  # preserve original setting
+                        keep = mapping.get('keep-for', {})
+                        keep[key] = m['keep-for']
+                        mapping['keep-for'] = keep
+                    if 'zoom-min' in m:  # account original setting
+                        if 'zoom-min' not in mapping or m['zoom-min'] < mapping['zoom-min']:
+                            mapping['zoom-min'] = m['zoom-min']
+                    render = m.get('render', False)  # account original render flag if it is explicitly set
+                    renderable = renderable or render
+                    m = mappings.tags[key].get(value, mappings.tags[key].get('__any__', {}))
+                if 'one-of' in m:
+                    if value not in m['one-of']:
+                        continue
+                if 'adjust' in m:
+                    value = m['adjust'](value)
+                if value is None:
+                    if key in mapping.get('keep-for', {}):
+                        del mapping['keep-for'][key]
+                    continue
+                if isinstance(value, str) and key not in ('name', 'name:en', 'name:de', 'name:ru',
+                                                          'ref', 'icao', 'iata', 'addr:housenumber',
+                                                          'opening_hours', 'wikipedia', 'website'):
+                    value = value.strip().lower()
+                    if ';' in value:
+                        value = value.split(';')[0]
+                filtered_tags[key] = value
+                render = m.get('render', True)
+                renderable = renderable or render
+                ignorable = ignorable and (m.get('ignore', not render))
+                if 'keep-for' in m:
+                    keep = mapping.get('keep-for', {})
+                    keep[key] = m['keep-for']
+                    mapping['keep-for'] = keep
+                for k in ('filter-area', 'buffer', 'enlarge', 'simplify', 'force-line', 'label',
+                          'filter-type', 'clip-buffer', 'keep-tags', 'basemap-label',
+                          'basemap-keep-tags', 'basemap-filter-area'):
+                    if k in m:
+                        mapping[k] = m[k]
+                if 'union' in m:
+                    if 'union' in mapping:
+                        if type(mapping['union']) is dict:
+                            combined_union = dict(mapping['union'])
+                        else:
+                            zoom = mapping.get('zoom-min', 0)
+                            combined_union = {k: zoom for k in mapping['union'].split(',')}
+                        if type(m['union']) is dict:
+                            for k, v in m['union'].items():
+                                if k not in combined_union or combined_union[k] > v:
+                                    combined_union[k] = v
+                        else:
+                            zoom = m.get('zoom-min', 0)
+                            for k in m['union'].split(','):
+                                if k not in combined_union or combined_union[k] > zoom:
+                                    combined_union[k] = zoom
+                        mapping['union'] = combined_union
+                    else:
+                        mapping['union'] = m['union']
+                transform_exclusive = m.get('transform-exclusive', False)
+                if 'transform' in m:
+                    # apply exclusive transform only if this is the first match
+                    if not transform_exclusive or mapping.get('transform-exclusive', None) is None:
+                        mapping['transform'] = m['transform']
+                    elif transform_exclusive:
+                        transform_exclusive = False
+                if render:
+                    if mapping.get('transform-exclusive', False):
+                        # if there was previous exclusive transform remove it
+                        if 'transform' not in m or transform_exclusive:
+                            del mapping['transform']
+                    mapping['transform-exclusive'] = transform_exclusive
+                if 'union-zoom-max' in m:
+                    if 'union-zoom-max' not in mapping or m['union-zoom-max'] < mapping['union-zoom-max']:
+                        mapping['union-zoom-max'] = m['union-zoom-max']
+                if 'zoom-min' in m:
+                    if 'zoom-min' not in mapping or m['zoom-min'] < mapping['zoom-min']:
+                        mapping['zoom-min'] = m['zoom-min']
+                if 'zoom-max' in m:
+                    if 'zoom-max' not in mapping or m['zoom-max'] > mapping['zoom-max']:
+                        mapping['zoom-max'] = m['zoom-max']
+                if 'modify-mapping' in m:
+                    modifiers.add(m['modify-mapping'])
+                if 'pre-process' in m:
+                    processors.add(m['pre-process'])
+
+    for modifier in modifiers:
+        renderable, ignorable, mapping = modifier(filtered_tags, renderable, ignorable, mapping)
+    if basemap and mapping.get('zoom-min', 0) > 7:
+        renderable = False
+    if renderable:
+        if 'add-tags' in mapping:
+            for k, v in mapping['add-tags'].items():
+                filtered_tags[k] = v
+        if 'keep-for' in mapping:
+            for k, v in mapping['keep-for'].items():
+                keep = [x.strip() for x in v.split(',')]
+                if not set(keep) & set(filtered_tags.keys()):
+                    del filtered_tags[k]
+        tag_filter = None
+        if basemap and 'basemap-keep-tags' in mapping:
+            tag_filter = mapping['basemap-keep-tags']
+        elif 'keep-tags' in mapping:
+            tag_filter = mapping['keep-tags']
+        if tag_filter:
+            keep = [x.strip() for x in tag_filter.split(',')]
+            filtered_tags = {k: filtered_tags[k] for k in set(keep) & set(filtered_tags.keys())}
+    return renderable, filtered_tags, mapping, renderable and ignorable, processors
+
+
+@pytest.mark.parametrize('basemap', [False, True])
+def test_rule_table_parity(basemap):
+    osm_filter = OsmFilter([], basemap, logging.getLogger(__name__))
+    for tags in load_corpus():
+        renderable, filtered_tags, mapping, ignorable, processors = legacy_filter(dict(tags), basemap)
+        ignored = osm_filter.ignorable
+        osm_filter.processors.clear()
+        assert osm_filter.filter(dict(tags)) == (renderable, filtered_tags, mapping), tags
+        assert osm_filter.ignorable - ignored == int(ignorable), tags
+        assert osm_filter.processors == processors, tags
+
+
+@pytest.mark.parametrize('cache_size', [16, 10000])
+def test_filter_cache_parity(cache_size):
+    corpus = load_corpus()
+    uncached = OsmFilter([], False, logging.getLogger(__name__))
+    cached = OsmFilter([], False, logging.getLogger(__name__), cache_size)
+    # repeated and renamed tags should hit cache but results must not be shared
+    for tags in corpus + corpus + [{k: v + ' 2' if k.startswith('name') and v else v for k, v in t.items()} for t in corpus]:
+        expected = uncached.filter(dict(tags))
+        result = cached.filter(dict(tags))
+        assert result == expected, tags
+        result[1]['probe'] = 'x'
+        result[2]['probe'] = 'x'
+    assert cached.ignorable == uncached.ignorable
+    assert cached.processors == uncached.processors
+    if cache_size > len(corpus):
+        assert cached.cache_hits >= len(corpus) * 2
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import math
+import time
+import queue
+import random
+import inspect
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+import logging.config
+from collections import defaultdict
+
+import mercantile
+from shapely.geometry import Point, LineString, Polygon
+from shapely.affinity import rotate
+
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import mappings
+import mapwrite
+from util.core import Element
+from util.database import MTilesDatabase
+from util.geometry import clockwise
+from util.store import load_elements
+
+
+# number of features per square kilometer
+DENSITIES = {
+    'sparse': {'buildings': 20, 'roads': 0.5, 'landuse': 0.05, 'contours': 0.02},
+    'medium': {'buildings': 200, 'roads': 2, 'landuse': 0.2, 'contours': 0.05},
+    'dense': {'buildings': 2000, 'roads': 8, 'landuse': 0.5, 'contours': 0.1},
+}
+
+BUILDINGS = ['yes', 'yes', 'yes', 'house', 'residential', 'apartments', 'industrial', 'garage']
+ROADS = ['motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'residential', 'residential', 'service',
+         'service', 'track', 'track', 'path', 'footway']
+LANDUSE = [{'landuse': 'forest'}, {'landuse': 'farmland'}, {'landuse': 'residential'}, {'landuse': 'meadow'},
+           {'natural': 'water'}, {'natural': 'wetland', 'wetland': 'marsh'}]
+
+
+class SyntheticArea:
+    """
+    Generates reproducible set of map elements for a tile area
+    """
+    def __init__(self, zoom, x, y, density, seed):
+        self.bounds = mercantile.xy_bounds(x, y, zoom)
+        self.random = random.Random(seed)
+        self.density = DENSITIES[density]
+        self.filter = mapwrite.OsmFilter([], False, logging.getLogger(__name__))
+        self.elements = []
+        lat = mercantile.lnglat((self.bounds.left + self.bounds.right) / 2, (self.bounds.top + self.bounds.bottom) / 2).lat
+        self.scale = math.cos(math.radians(lat))  # mercator meters to ground meters
+        width = (self.bounds.right - self.bounds.left) * self.scale / 1000
+        height = (self.bounds.top - self.bounds.bottom) * self.scale / 1000
+        self.square = width * height
+
+    def count(self, kind):
+        return int(self.density[kind] * self.square)
+
+    def point(self):
+        return self.random.uniform(self.bounds.left, self.bounds.right), self.random.uniform(self.bounds.bottom, self.bounds.top)
+
+    def add(self, geom, tags):
+        renderable, tags, mapping = self.filter.filter(tags)
+        if not renderable:
+            return
+        element = Element((len(self.elements) << 2) + 2, clockwise(geom), tags, mapping)
+        element.kind, element.type, element.area, element.label, element.building = \
+            mapwrite.process_element(element.geom, element.tags, element.mapping)
+        self.elements.append(element)
+
+    def add_extra(self, geom, kind, tags, mapping):
+        element = Element(None, geom, tags, mapping)
+        if kind:
+            element.kind = kind
+        self.elements.append(element)
+
+    def generate(self):
+        # settlements attract buildings and minor roads
+        settlements = [self.point() for _ in range(max(1, self.count('buildings') // 500))]
+        for _ in range(self.count('landuse')):
+            cx, cy = self.point()
+            radius = self.random.uniform(200, 3000) / self.scale
+            points = []
+            for i in range(self.random.randint(6, 24)):
+                angle = 2 * math.pi * i / 24 + self.random.uniform(0, 0.2)
+                r = radius * self.random.uniform(0.6, 1.0)
+                points.append((cx + r * math.cos(angle), cy + r * math.sin(angle)))
+            polygon = Polygon(points)
+            if polygon.is_valid:
+                self.add(polygon, dict(self.random.choice(LANDUSE)))
+        for _ in range(self.count('roads')):
+            x, y = self.point()
+            points = [(x, y)]
+            heading = self.random.uniform(0, 2 * math.pi)
+            for _ in range(self.random.randint(5, 60)):
+                heading += self.random.uniform(-0.5, 0.5)
+                step = self.random.uniform(20, 300) / self.scale
+                x += step * math.cos(heading)
+                y += step * math.sin(heading)
+                points.append((x, y))
+            tags = {'highway': self.random.choice(ROADS)}
+            if self.random.random() < 0.2:
+                tags['name'] = 'Road %d' % self.random.randint(1, 50)
+            self.add(LineString(points), tags)
+        for _ in range(self.count('buildings')):
+            sx, sy = self.random.choice(settlements)
+            spread = 2000 / self.scale
+            x = sx + self.random.gauss(0, spread)
+            y = sy + self.random.gauss(0, spread)
+            w = self.random.uniform(5, 30) / self.scale
+            h = self.random.uniform(5, 20) / self.scale
+            footprint = Polygon([(x, y), (x + w, y), (x + w, y + h), (x, y + h)])
+            footprint = rotate(footprint, self.random.uniform(0, 90), origin='centroid')
+            tags = {'building': self.random.choice(BUILDINGS)}
+            if self.random.random() < 0.1:
+                tags['building:levels'] = str(self.random.randint(1, 12))
+            if self.random.random() < 0.05:
+                tags['addr:housenumber'] = str(self.random.randint(1, 200))
+            self.add(footprint, tags)
+        for _ in range(self.count('contours')):
+            cx, cy = self.point()
+            top = self.random.randint(3, 60) * 10
+            for elevation in range(10, top + 1, 10):
+                radius = (top - elevation + 10) * self.random.uniform(5, 15) / self.scale
+                ring = Point(cx, cy).buffer(radius, 8).exterior
+                kind, tags, mapping = mappings._contours_mapper({'elevation': elevation})
+                self.add_extra(LineString(ring.coords), kind, tags, mapping)
+        return self.elements
+
+
+class BenchmarkWriter(mapwrite.MapWriter):
+    """
+    Map writer that generates tiles in current thread and measures time spent on each zoom
+    """
+    def __init__(self, data_dir, vectorized=False):
+        super().__init__(data_dir, forbid_interactive=True, single_thread=True, vectorized=vectorized)
+        self.zoom_time = defaultdict(float)
+        self.zoom_tiles = defaultdict(int)
+
+    def generateTile(self, tile):
+        start = time.perf_counter()
+        super().generateTile(tile)
+        self.zoom_time[tile.zoom] += time.perf_counter() - start
+        self.zoom_tiles[tile.zoom] += 1
+
+    def run(self, zoom, x, y, elements):
+        map_path = os.path.join(self.data_dir, 'benchmark.mtiles')
+        if os.path.exists(map_path):
+            os.remove(map_path)
+        self.basemap = zoom == 0
+        self.db = MTilesDatabase(map_path)
+        self.db.create('benchmark', 'baselayer', 0, 'maptrek')
+        tile_queue = queue.Queue()
+        db_queue = queue.Queue()
+        db_thread = threading.Thread(target=self.dbWorker, args=(db_queue,))
+        db_thread.start()
+        start = time.perf_counter()
+        tile_queue.put(mapwrite.Tile(zoom, x, y, elements))
+        worker = threading.Thread(target=self.tileWorker, args=(tile_queue, db_queue))
+        worker.start()
+        tile_queue.join()
+        tile_queue.put(None)
+        worker.join()
+        db_queue.join()
+        db_queue.put(None)
+        db_thread.join()
+        elapsed = time.perf_counter() - start
+        self.db.finish()
+        size = os.path.getsize(map_path)
+        os.remove(map_path)
+        tiles = sum(n for z, n in self.zoom_tiles.items() if (self.basemap and z > 0) or z > 7)
+        encode_time = sum(elapsed for (z, operation), (count, elapsed) in self.profile.operations.items() if operation == 'encode')
+        return {
+            'tiles': tiles,
+            'elapsed': elapsed,
+            'tiles_per_second': tiles / elapsed if elapsed else 0,
+            'encode_time': encode_time,
+            'zooms': {str(z): {'tiles': self.zoom_tiles[z], 'time': self.zoom_time[z]} for z in sorted(self.zoom_time)},
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+            'output_size': size
+        }
+
+
+# small z7 area recorded with mapwrite.py --dump-elements, needs neither database nor planet file
+RECORDED_INPUT = os.path.join(currentdir, 'data', 'benchmark-67-43.elements.gz')
+
+
+def run_once(args, zoom, x, y):
+    if args.input:
+        elements = load_elements(args.input)[3]
+    else:
+        elements = SyntheticArea(zoom, x, y, args.density, args.seed).generate()
+    with tempfile.TemporaryDirectory() as data_dir:
+        writer = BenchmarkWriter(data_dir, args.vectorized)
+        result = writer.run(zoom, x, y, elements)
+    result['elements'] = len(elements)
+    return result
+
+
+def run_benchmark(args):
+    if args.recorded:
+        args.input = RECORDED_INPUT
+    if args.input:
+        zoom, x, y = load_elements(args.input)[:3]
+        description = args.input
+    else:
+        (zoom, x, y) = map(int, args.tile.split('/'))
+        description = 'synthetic {} {}/{}/{} seed {}'.format(args.density, zoom, x, y, args.seed)
+    results = []
+    for i in range(args.repeat):
+        # each run gets its own process, so that elements are not reused and peak memory is not accumulated
+        with multiprocessing.Pool(1) as pool:
+            result = pool.apply(run_once, (args, zoom, x, y))
+        print_result(description, result)
+        results.append(result)
+    best = min(results, key=lambda r: r['elapsed'])
+    best['input'] = description
+    best['vectorized'] = args.vectorized
+    return best
+
+
+def print_result(description, result):
+    print("{}: {:,} elements, {:,} tiles in {:.2f}s ({:.1f} tiles/s), encode {:.2f}s, peak RSS {:,}M, output {:,}K"
+          .format(description, result['elements'], result['tiles'], result['elapsed'], result['tiles_per_second'],
+                  result['encode_time'], result['peak_rss'], result['output_size'] // 1024))
+    for zoom, stats in result['zooms'].items():
+        print("  zoom {:>2s}: {:6,} tiles {:8.2f}s".format(zoom, stats['tiles'], stats['time']))
+
+
+def compare(base_path, new_path):
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def row(title, a, b, fmt='{:12,.2f}', higher_better=False):
+        if higher_better:
+            ratio = '{:8.2f}x'.format(b / a) if a else '       -'
+        else:
+            ratio = '{:8.2f}x'.format(a / b) if b else '       -'
+        print('{:20s}'.format(title) + fmt.format(a) + fmt.format(b) + ratio)
+
+    print('{:20s}{:>12s}{:>12s}{:>9s}'.format('', 'base', 'new', 'speedup'))
+    row('elapsed, s', base['elapsed'], new['elapsed'])
+    row('encode, s', base['encode_time'], new['encode_time'])
+    for zoom in sorted(set(base['zooms']) | set(new['zooms']), key=int):
+        row('zoom %s, s' % zoom, base['zooms'].get(zoom, {}).get('time', 0), new['zooms'].get(zoom, {}).get('time', 0))
+    row('tiles/s', base['tiles_per_second'], new['tiles_per_second'], higher_better=True)
+    row('peak RSS, M', base['peak_rss'], new['peak_rss'], '{:12,.0f}')
+    row('output, K', base['output_size'] / 1024, new['output_size'] / 1024, '{:12,.0f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='MapTrek tile generation benchmark')
+    parser.add_argument('-i', '--input', help='recorded elements file (see mapwrite.py --dump-elements)')
+    parser.add_argument('-R', '--recorded', action='store_true', help='use bundled recorded z7 area as input')
+    parser.add_argument('-t', '--tile', default='10/598/300', help='area of synthetic input: zoom/x/y')
+    parser.add_argument('-d', '--density', default='medium', choices=DENSITIES.keys(), help='synthetic input density')
+    parser.add_argument('-s', '--seed', default=1, type=int, help='synthetic input random seed')
+    parser.add_argument('-r', '--repeat', default=1, type=int, help='number of runs, best one is reported')
+    parser.add_argument('-o', '--output', help='save results to file')
+    parser.add_argument('-c', '--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two saved results')
+    parser.add_argument('--vectorized', action='store_true', help='use vectorized geometry processing')
+    parser.add_argument('-l', '--log', default='ERROR', help='set logging verbosity')
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.log.upper(), None)
+    if not isinstance(log_level, int):
+        print("Invalid log level: %s" % args.log)
+        exit(1)
+
+    logging.basicConfig(level=log_level, format='%(asctime)s %(levelname)s - %(message)s', datefmt='%H:%M:%S')
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        benchmark = run_benchmark(args)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(benchmark, f, indent=2)
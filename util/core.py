@@ -13,6 +13,8 @@ class Element:
         self.building = None
         self.geometry = None  # tile processed temporary geometry
         self.merged = False  # flag merged element for potential cleaning
+        self.index = None  # index in shared element store
+        self.digest = None  # input fingerprint cache
 
     def osm_id(self):
         t = 0
@@ -30,6 +32,13 @@ class Element:
     def __repr__(self):
         return str(self)
 
+    @property
+    def attributes(self):
+        """
+        properties computed from full element geometry
+        """
+        return self.label, self.area, self.kind, self.type, self.building
+
     def clone(self, geom):
         el = Element(self.id, geom, self.tags, self.mapping)
         el.label = self.label
@@ -37,4 +46,5 @@ class Element:
         el.kind = self.kind
         el.type = self.type
         el.building = self.building
+        el.index = self.index
         return el
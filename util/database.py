@@ -1,11 +1,13 @@
 import re
+import time
+import threading
 
 from typing import Optional
 
 from sqlite3 import connect, Connection
 from spooky import hash64
-from shapely.ops import transform
-from util.geometry import mercator_to_wgs84
+from util.projection import point_to_wgs84
+from util.fingerprint import content_hash
 from util.url import iri2uri
 from util.smaz import compress
 from util.codebooks import WEBSITE_TREE, OPENING_HOURS_TREE, PHONE_TREE
@@ -13,17 +15,38 @@ from util.codebooks import WEBSITE_TREE, OPENING_HOURS_TREE, PHONE_TREE
 OH_CLEANUP_PATTERN = re.compile(r'\s+([\s,;])')
 PHONE_CLEANUP_PATTERN = re.compile(r'[ ()\-.]')
 TILE_INSERT_QUERY: str = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
+TILE_REF_INSERT_QUERY: str = 'REPLACE INTO tile_refs (zoom_level, tile_column, tile_row, tile_hash) VALUES (?, ?, ?, ?)'
+TILE_BLOB_INSERT_QUERY: str = 'INSERT OR IGNORE INTO tile_blobs (hash, tile_data) VALUES (?, ?)'
 NAME_INSERT_QUERY: str = 'REPLACE INTO names (ref, name) VALUES (?, ?)'
 FEATURE_NAME_INSERT_QUERY: str = 'REPLACE INTO feature_names (id, lang, name) VALUES (?, ?, ?)'
 FEATURE_INSERT_QUERY: str = 'REPLACE INTO features (id, kind, type, lat, lon, opening_hours, phone, wikipedia, website, flags, enum1) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
 
+BATCH_SIZE: int = 1000  # maximum number of buffered rows
+FLUSH_INTERVAL: float = 5.0  # maximum time between transaction commits, seconds
+
 
 class MTilesDatabase:
 
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL, dedup: bool = False):
         self.filename: str = filename
         self.namehashes: list = []
         self.db: Optional[Connection] = None
+        # identical tiles are stored once in tile_blobs table, tiles view provides the usual schema for readers
+        self.dedup: bool = dedup
+        self.blobhashes: set = set()
+        self.tile_count: int = 0
+        self.tile_size: int = 0
+        self.blob_count: int = 0
+        self.blob_size: int = 0
+        # rows are buffered per query and written with executemany, order of rows in each table is preserved,
+        # committing each batch costs more then it saves so transaction is committed at flush interval
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+        self.batches: dict = {TILE_INSERT_QUERY: [], TILE_BLOB_INSERT_QUERY: [], TILE_REF_INSERT_QUERY: [], NAME_INSERT_QUERY: [],
+                              FEATURE_NAME_INSERT_QUERY: [], FEATURE_INSERT_QUERY: []}
+        self.batched: int = 0
+        self.flushed: float = time.monotonic()
+        self.lock = threading.Lock()
 
     def create(self, name: str, db_type: str, timestamp: int, db_format: str, bounds=None):
         self.db = connect(self.filename, check_same_thread=False)
@@ -36,11 +59,10 @@ class MTilesDatabase:
             self.db.execute('DELETE FROM metadata')
         except:
             self.db.execute('CREATE TABLE metadata (name TEXT NOT NULL, value TEXT)')
-            self.db.execute('CREATE TABLE tiles (zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL, tile_data BLOB NOT NULL)')
+            self.createTileTables()
             self.db.execute('CREATE TABLE names (ref INTEGER NOT NULL, name TEXT NOT NULL)')
             self.db.execute('CREATE TABLE feature_names (id INTEGER NOT NULL, lang INTEGER NOT NULL, name INTEGER NOT NULL)')
             self.db.execute('CREATE TABLE features (id INTEGER NOT NULL, kind INTEGER, type INTEGER, lat REAL, lon REAL, opening_hours TEXT, phone TEXT, wikipedia TEXT, website TEXT, flags INTEGER, enum1 INTEGER)')
-            self.db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
             self.db.execute('CREATE UNIQUE INDEX property ON metadata (name)')
             self.db.execute('CREATE UNIQUE INDEX name_ref ON names (ref)')
             self.db.execute('CREATE UNIQUE INDEX feature_name_lang ON feature_names (id, lang)')
@@ -53,6 +75,16 @@ class MTilesDatabase:
                 self.db.execute('CREATE TABLE map_features (x INTEGER NOT NULL, y INTEGER NOT NULL, feature INTEGER NOT NULL)')
                 self.db.execute('CREATE INDEX map_feature_ids ON map_features (feature)')
                 self.db.execute('CREATE UNIQUE INDEX map_feature_refs ON map_features (x, y, feature)')
+        else:
+            if self.isDeduplicated() != self.dedup:
+                # tiles are regenerated anyway, so storage layout is recreated instead of converted
+                if self.dedup:
+                    self.db.execute('DROP TABLE tiles')
+                else:
+                    self.db.execute('DROP VIEW tiles')
+                    self.db.execute('DROP TABLE tile_refs')
+                    self.db.execute('DROP TABLE tile_blobs')
+                self.createTileTables()
 
         self.db.execute('INSERT INTO metadata VALUES (?, ?)', ('name', name))
         self.db.execute('INSERT INTO metadata VALUES (?, ?)', ('type', db_type))
@@ -67,10 +99,60 @@ class MTilesDatabase:
         self.db.commit()
         self.db.text_factory = bytes
 
+    def createTileTables(self):
+        if self.dedup:
+            self.db.execute('CREATE TABLE tile_blobs (hash INTEGER NOT NULL PRIMARY KEY, tile_data BLOB NOT NULL)')
+            self.db.execute('CREATE TABLE tile_refs (zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL, tile_hash INTEGER NOT NULL)')
+            self.db.execute('CREATE UNIQUE INDEX coord ON tile_refs (zoom_level, tile_column, tile_row)')
+            self.db.execute('CREATE VIEW tiles AS SELECT zoom_level, tile_column, tile_row, tile_data FROM tile_refs JOIN tile_blobs ON tile_blobs.hash = tile_refs.tile_hash')
+        else:
+            self.db.execute('CREATE TABLE tiles (zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL, tile_data BLOB NOT NULL)')
+            self.db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
+
+    def isDeduplicated(self) -> bool:
+        cursor = self.db.execute("SELECT type FROM sqlite_master WHERE name = 'tiles'")
+        return cursor.fetchone()[0] == 'view'
+
+    def dedupRatio(self) -> float:
+        """
+        returns ratio of stored tile data size to total size of put tiles
+        """
+        if self.tile_size == 0:
+            return 1.0
+        return self.blob_size / self.tile_size
+
     def commit(self):
+        self.flush()
         self.db.commit()
 
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.batched:
+            for query, rows in self.batches.items():
+                if rows:
+                    self.db.executemany(query, rows)
+                    rows.clear()
+            self.batched = 0
+        now = time.monotonic()
+        if now - self.flushed >= self.flush_interval:
+            self.db.commit()
+            self.flushed = now
+
+    def _put(self, query: str, row: tuple):
+        with self.lock:
+            self.batches[query].append(row)
+            self.batched += 1
+            if self.batched >= self.batch_size:
+                self._flush()
+
     def finish(self):
+        self.flush()
+        if self.dedup:
+            # remove data of replaced tiles
+            self.db.execute('DELETE FROM tile_blobs WHERE hash NOT IN (SELECT tile_hash FROM tile_refs)')
         self.db.commit()
         self.db.execute('VACUUM')
         self.db.close()
@@ -88,7 +170,20 @@ class MTilesDatabase:
         return date and count == 21844
 
     def putTile(self, zoom: int, x: int, y: int, content: bytes):
-        self.db.execute(TILE_INSERT_QUERY, (zoom, x, y, memoryview(content)))
+        self.tile_count += 1
+        self.tile_size += len(content)
+        if self.dedup:
+            h = content_hash(content)
+            if h not in self.blobhashes:
+                self.blobhashes.add(h)
+                self.blob_count += 1
+                self.blob_size += len(content)
+                self._put(TILE_BLOB_INSERT_QUERY, (h, memoryview(content)))
+            self._put(TILE_REF_INSERT_QUERY, (zoom, x, y, h))
+        else:
+            self.blob_count += 1
+            self.blob_size += len(content)
+            self._put(TILE_INSERT_QUERY, (zoom, x, y, memoryview(content)))
 
         """
         86M /gis/data/7/74/74-37.mtiles
@@ -103,22 +198,22 @@ class MTilesDatabase:
             h = -0x10000000000000000 + h
         if h in self.namehashes:
             return h
-        self.db.execute(NAME_INSERT_QUERY, (h, name))
+        self._put(NAME_INSERT_QUERY, (h, name))
         return h
 
-    def putFeature(self, el_id: int, tags: dict, kind: int, el_type: int, label, geometry):
+    def putFeature(self, el_id: int, tags: dict, kind: int, el_type: int, label, geometry, position=None):
         if 'name' in tags:
             h = self.putName(tags['name'])
-            self.db.execute(FEATURE_NAME_INSERT_QUERY, (el_id, 0, h))
+            self._put(FEATURE_NAME_INSERT_QUERY, (el_id, 0, h))
             if 'name:en' in tags:
                 h = self.putName(tags['name:en'])
-                self.db.execute(FEATURE_NAME_INSERT_QUERY, (el_id, 840, h))
+                self._put(FEATURE_NAME_INSERT_QUERY, (el_id, 840, h))
             if 'name:de' in tags:
                 h = self.putName(tags['name:de'])
-                self.db.execute(FEATURE_NAME_INSERT_QUERY, (el_id, 276, h))
+                self._put(FEATURE_NAME_INSERT_QUERY, (el_id, 276, h))
             if 'name:ru' in tags:
                 h = self.putName(tags['name:ru'])
-                self.db.execute(FEATURE_NAME_INSERT_QUERY, (el_id, 643, h))
+                self._put(FEATURE_NAME_INSERT_QUERY, (el_id, 643, h))
         lat: Optional[float] = None
         lon: Optional[float] = None
         opening_hours: Optional[str] = None
@@ -127,17 +222,16 @@ class MTilesDatabase:
         website: Optional[str] = None
         flags: Optional[int] = None
         enum1: Optional[int] = None
-        if label:
+        if position is not None:
+            # computed by caller for many features at once
+            lon, lat = position
+        elif label:
             if isinstance(label, list):
-                geom = transform(mercator_to_wgs84, label[0])
+                lon, lat = point_to_wgs84(label[0])
             else:
-                geom = transform(mercator_to_wgs84, label)
-            lat = geom.y
-            lon = geom.x
+                lon, lat = point_to_wgs84(label)
         elif geometry.type == 'Point':
-            geom = transform(mercator_to_wgs84, geometry)
-            lat = geom.y
-            lon = geom.x
+            lon, lat = point_to_wgs84(geometry)
         if kind and kind & 0x0FFBFFF8 != 0:  # skip places, roads, buildings, barriers
             if 'opening_hours' in tags:
                 oh = tags['opening_hours']
@@ -171,4 +265,4 @@ class MTilesDatabase:
             if 'enum1' in tags:
                 enum1 = tags['enum1']
 
-        self.db.execute(FEATURE_INSERT_QUERY, (el_id, kind, el_type, lat, lon, opening_hours, phone, wikipedia, website, flags, enum1))
+        self._put(FEATURE_INSERT_QUERY, (el_id, kind, el_type, lat, lon, opening_hours, phone, wikipedia, website, flags, enum1))
@@ -0,0 +1,84 @@
+import queue
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class QueryFetcher:
+    """
+    Runs independent queries concurrently over a small connection pool. Rows are passed back in batches
+    through a queue of each query, so results can be consumed in query order while later queries are still
+    executed by database. Query errors are logged and end query results, other errors (e.g. lost connection)
+    are re-raised to consumer as partial results should not make a map.
+    """
+    def __init__(self, dsn, connections, logger, setup=None, **kwargs):
+        self.logger = logger
+        self.setup = setup  # called once for each new connection
+        self.prepared = weakref.WeakSet()  # connections are tracked by themselves as ids of closed ones are reused
+        self.pending = set()  # queues of queries which results are not consumed completely
+        self.pool = ThreadedConnectionPool(1, connections, dsn, **kwargs)
+        self.executor = ThreadPoolExecutor(connections, thread_name_prefix="query")
+
+    def submit(self, fetch, sql, limit=0):
+        """
+        schedules fetch(connection, sql, emit) and returns iterator over row batches passed to emit(rows),
+        if limit is set fetch is blocked while that many batches are not consumed
+        """
+        results = queue.Queue(limit)
+        self.pending.add(results)
+        self.executor.submit(self.run, fetch, sql, results)
+        return self.batches(results)
+
+    def run(self, fetch, sql, results):
+        connection = None
+        try:
+            connection = self.pool.getconn()
+            if self.setup and connection not in self.prepared:
+                self.setup(connection)
+                self.prepared.add(connection)
+            fetch(connection, sql, results.put)
+        except (psycopg2.ProgrammingError, psycopg2.InternalError):
+            self.logger.exception("Query error: %s" % sql)
+        except Exception as e:
+            results.put(e)
+        finally:
+            try:
+                if connection is not None:
+                    self.release(connection)
+            finally:
+                results.put(None)
+
+    def release(self, connection):
+        if not connection.closed:
+            try:
+                # end transaction so that connection can be reused by next query
+                connection.rollback()
+            except psycopg2.Error:
+                connection.close()
+        self.pool.putconn(connection, close=bool(connection.closed))
+
+    def batches(self, results):
+        while True:
+            batch = results.get()
+            if batch is None:
+                self.pending.discard(results)
+                return
+            if isinstance(batch, Exception):
+                # results are still terminated by None
+                results.get()
+                self.pending.discard(results)
+                raise batch
+            yield batch
+
+    def close(self):
+        # unblock queries which results were abandoned
+        for results in list(self.pending):
+            try:
+                for _ in self.batches(results):
+                    pass
+            except Exception:
+                pass  # abandoned query failed, its error is irrelevant now
+        self.executor.shutdown()
+        self.pool.closeall()
@@ -0,0 +1,204 @@
+import os
+import glob
+import hashlib
+from array import array
+from sqlite3 import connect, DatabaseError
+
+
+def content_hash(content) -> int:
+    """
+    Returns signed 64-bit hash of tile content suitable for SQLite INTEGER
+    """
+    return int.from_bytes(hashlib.blake2b(content, digest_size=8).digest(), byteorder='big', signed=True)
+
+
+def code_digest(base_dir, *flags) -> bytes:
+    """
+    Returns digest of map generation code and options, any change of them invalidates all fingerprints
+    """
+    h = hashlib.blake2b(digest_size=16)
+    paths = [os.path.join(base_dir, 'mapwrite.py'), os.path.join(base_dir, 'mappings.py')]
+    for directory in ('encoder', 'util'):
+        paths.extend(glob.glob(os.path.join(base_dir, directory, '**', '*.py'), recursive=True))
+    for path in sorted(paths):
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    h.update(repr(flags).encode())
+    return h.digest()
+
+
+def element_digest(element, wkb=None) -> bytes:
+    """
+    Returns digest of element identity, geometry, tags and attributes, it is cached in element as elements
+    are shared by many tiles. Attributes are computed from full geometry so they are accounted separately
+    from (possibly clipped) geometry.
+    """
+    if element.digest is None:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(wkb if wkb is not None else element.geom.wkb)
+        label, area, kind, el_type, building = element.attributes
+        if isinstance(label, list):
+            label = [(point.x, point.y) for point in label]
+        elif label is not None:
+            label = (label.x, label.y)
+        h.update(repr((element.id, sorted(element.tags.items()), label, area, kind, el_type, building)).encode())
+        element.digest = h.digest()
+    return element.digest
+
+
+def tile_fingerprint(salt, tile) -> int:
+    """
+    Returns fingerprint of tile input: code, tile position and all tile elements in their order
+    """
+    h = hashlib.blake2b(salt, digest_size=8)
+    h.update(b'%d/%d/%d' % (tile.zoom, tile.x, tile.y))
+    for element in tile.elements:
+        h.update(element_digest(element))
+    return int.from_bytes(h.digest(), byteorder='big', signed=True)
+
+
+class FingerprintDatabase:
+    """
+    Side database of tile fingerprints and hashes of tiles generated from them
+    """
+    def __init__(self, filename: str):
+        self.filename: str = filename
+
+    def load(self) -> dict:
+        """
+        returns (fingerprint, tile hash) for each tile
+        """
+        if not os.path.exists(self.filename):
+            return {}
+        db = connect(self.filename)
+        try:
+            return {(z, x, y): (fingerprint, tile_hash) for z, x, y, fingerprint, tile_hash in
+                    db.execute('SELECT zoom_level, tile_column, tile_row, fingerprint, tile_hash FROM tile_fingerprints')}
+        finally:
+            db.close()
+
+    def create(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.db = connect(self.filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('CREATE TABLE tile_fingerprints (zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL, fingerprint INTEGER NOT NULL, tile_hash INTEGER NOT NULL)')
+        self.db.execute('CREATE UNIQUE INDEX coord ON tile_fingerprints (zoom_level, tile_column, tile_row)')
+
+    def put(self, zoom: int, x: int, y: int, fingerprint: int, tile_hash: int):
+        self.db.execute('REPLACE INTO tile_fingerprints (zoom_level, tile_column, tile_row, fingerprint, tile_hash) VALUES (?, ?, ?, ?, ?)',
+                        (zoom, x, y, fingerprint, tile_hash))
+
+    def finish(self):
+        self.db.commit()
+        self.db.close()
+        self.db = None
+
+
+class PreviousMap:
+    """
+    Read only access to tiles of previously generated map
+    """
+    def __init__(self, filename: str, fingerprints: dict):
+        self.filename: str = filename
+        self.fingerprints: dict = fingerprints
+        self.db = None
+        self.pid = None
+
+    def getTile(self, zoom: int, x: int, y: int, fingerprint: int):
+        """
+        returns content of previously generated tile if it was generated from the same input
+        """
+        previous = self.fingerprints.get((zoom, x, y), None)
+        if previous is None or previous[0] != fingerprint:
+            return None
+        # connection can not be shared with forked worker processes
+        if self.db is None or self.pid != os.getpid():
+            self.db = connect('file:{}?mode=ro'.format(self.filename), uri=True, check_same_thread=False)
+            self.pid = os.getpid()
+        row = self.db.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                              (zoom, x, y)).fetchone()
+        if row is None:
+            return None
+        content = bytes(row[0])
+        # fingerprints could outlive the map they were made for
+        if content_hash(content) != previous[1]:
+            return None
+        return content
+
+
+class LabelDatabase:
+    """
+    Side database of building labels keyed by geometry hash. Labels of previous run are looked up by
+    element processing workers while labels of current run are written to new database which replaces
+    previous one when elements are processed.
+    """
+    def __init__(self, filename: str, salt: bytes):
+        self.filename: str = filename
+        self.salt: bytes = salt
+        self.db = None
+        self.pid = None
+        self.writer = None
+
+    def valid(self) -> bool:
+        """
+        returns True if previous labels exist and were made by the same code
+        """
+        if not os.path.exists(self.filename):
+            return False
+        db = connect('file:{}?mode=ro'.format(self.filename), uri=True)
+        try:
+            row = db.execute('SELECT salt FROM label_salt').fetchone()
+            return row is not None and bytes(row[0]) == self.salt
+        except DatabaseError:
+            return False
+        finally:
+            db.close()
+
+    def lookup(self, hashes: list) -> dict:
+        """
+        returns label coordinates, a tuple for polygon or list of tuples for multipolygon, for known hashes
+        """
+        # connection can not be shared with forked worker processes
+        if self.db is None or self.pid != os.getpid():
+            self.db = connect('file:{}?mode=ro'.format(self.filename), uri=True, check_same_thread=False)
+            self.pid = os.getpid()
+        result = {}
+        sql = 'SELECT hash, multi, coords FROM labels WHERE hash IN ({})'.format(','.join('?' * len(hashes)))
+        for h, multi, coords in self.db.execute(sql, hashes):
+            coords = array('d', coords)
+            points = list(zip(coords[0::2], coords[1::2]))
+            result[h] = points if multi else points[0]
+        return result
+
+    def create(self):
+        path = self.filename + '.new'
+        if os.path.exists(path):
+            os.remove(path)
+        self.writer = connect(path, check_same_thread=False)
+        self.writer.execute('PRAGMA journal_mode = OFF')
+        self.writer.execute('PRAGMA synchronous = OFF')
+        self.writer.execute('CREATE TABLE label_salt (salt BLOB NOT NULL)')
+        self.writer.execute('CREATE TABLE labels (hash INTEGER PRIMARY KEY, multi INTEGER NOT NULL, coords BLOB NOT NULL)')
+        self.writer.execute('INSERT INTO label_salt (salt) VALUES (?)', (self.salt,))
+
+    def put(self, labels: list):
+        """
+        stores (hash, label coordinates) pairs
+        """
+        rows = []
+        for h, label in labels:
+            if isinstance(label, list):
+                rows.append((h, 1, array('d', [c for point in label for c in point]).tobytes()))
+            else:
+                rows.append((h, 0, array('d', label).tobytes()))
+        self.writer.executemany('INSERT OR IGNORE INTO labels (hash, multi, coords) VALUES (?, ?, ?)', rows)
+
+    def finish(self):
+        self.writer.commit()
+        self.writer.close()
+        self.writer = None
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        os.replace(self.filename + '.new', self.filename)
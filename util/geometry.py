@@ -1,16 +1,42 @@
-from functools import partial
+import warnings
 
-import pyproj
+import numpy
+import shapely
 from shapely import geometry
+from shapely.strtree import STRtree
 from shapely.geometry.polygon import orient
-from shapely.algorithms.polylabel import polylabel as shapely_polylabel
 
+# STRtree returns indices instead of geometries since Shapely 2.0
+STRTREE_INDICES = hasattr(shapely, 'get_type_id')
 
-wgs84 = pyproj.Proj(init='epsg:4326')
-mercator = pyproj.Proj(init='epsg:3857')
 
-wgs84_to_mercator = partial(pyproj.transform, wgs84, mercator)
-mercator_to_wgs84 = partial(pyproj.transform, mercator, wgs84)
+def geometry_bounds(geoms):
+    """
+    Returns array of geometry bounds (minx, miny, maxx, maxy), empty geometries have NaN bounds
+    """
+    result = numpy.full((len(geoms), 4), numpy.nan)
+    for i, geom in enumerate(geoms):
+        if not geom.is_empty:
+            result[i] = geom.bounds
+    return result
+
+
+class GeometryIndex:
+    """
+    Spatial index of geometry list, query returns list positions of geometries which bounds intersect
+    given geometry in ascending order
+    """
+    def __init__(self, geoms):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # Shapely 1.8 warns about upcoming STRtree changes
+            self.tree = STRtree(geoms)
+        if not STRTREE_INDICES:
+            self.positions = {id(geom): i for i, geom in enumerate(geoms)}
+
+    def query(self, geom):
+        if STRTREE_INDICES:
+            return sorted(self.tree.query(geom).tolist())
+        return sorted(self.positions[id(g)] for g in self.tree.query(geom))
 
 
 def clockwise(geom):
@@ -46,19 +72,147 @@ def clockwise_polygon(polygon):
         return polygon
 
 
-def polylabel(geom):
-    label = None
+LABEL_PRECISION = 1.194  # pixel width at zoom 17
+# relative tolerance of cross product for vertices considered collinear in convexity test
+CONVEX_TOLERANCE = 1e-3
+# maximum number of point to segment distances computed at once
+DISTANCE_BATCH = 1 << 20
+
+
+def _ring_segments(polygon):
+    """
+    Returns segment start and end coordinates of all polygon rings
+    """
+    starts = []
+    ends = []
+    for ring in (polygon.exterior, *polygon.interiors):
+        coords = numpy.asarray(ring.coords)[:, :2]
+        starts.append(coords[:-1])
+        ends.append(coords[1:])
+    return numpy.concatenate(starts), numpy.concatenate(ends)
+
+
+def _signed_distances(xs, ys, starts, ends):
+    """
+    Returns distances from points to polygon outline given by its segments, negative for outside points
+    """
+    if len(xs) * len(starts) > DISTANCE_BATCH:
+        step = max(1, DISTANCE_BATCH // len(starts))
+        return numpy.concatenate([_signed_distances(xs[i:i + step], ys[i:i + step], starts, ends)
+                                  for i in range(0, len(xs), step)])
+    px = xs[:, None]
+    py = ys[:, None]
+    ax, ay = starts[:, 0], starts[:, 1]
+    bx, by = ends[:, 0], ends[:, 1]
+    dx = bx - ax
+    dy = by - ay
+    length = dx * dx + dy * dy
+    length[length == 0] = 1.0  # zero length segments have zero projection anyway
+    t = numpy.clip(((px - ax) * dx + (py - ay) * dy) / length, 0.0, 1.0)
+    distance = numpy.sqrt(numpy.min((ax + t * dx - px) ** 2 + (ay + t * dy - py) ** 2, axis=1))
+    # even-odd rule also accounts for holes
+    crossing = (ay > py) != (by > py)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        x = ax + (py - ay) * dx / dy
+    inside = numpy.count_nonzero(crossing & (px < x), axis=1) % 2 == 1
+    return numpy.where(inside, distance, -distance)
+
+
+def _convex_centroid(polygon):
+    """
+    Returns centroid coordinates of convex polygon without holes or None if polygon is not convex,
+    centroid of convex polygon always lies inside it
+    """
+    if polygon.interiors:
+        return None
+    coords = numpy.asarray(polygon.exterior.coords)[:, :2]
+    if len(coords) < 4:
+        return None
+    edges = numpy.diff(numpy.vstack((coords, coords[1:2])), axis=0)
+    cross = edges[:-1, 0] * edges[1:, 1] - edges[:-1, 1] * edges[1:, 0]
+    lengths = numpy.hypot(edges[:, 0], edges[:, 1])
+    tolerance = CONVEX_TOLERANCE * lengths[:-1] * lengths[1:]
+    if numpy.any(cross > tolerance) and numpy.any(cross < -tolerance):
+        return None
+    # shoelace formula relative to first vertex for better precision
+    x = coords[:, 0] - coords[0, 0]
+    y = coords[:, 1] - coords[0, 1]
+    a = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area = a.sum()
+    if area == 0:
+        return None
+    cx = ((x[:-1] + x[1:]) * a).sum() / (3 * area) + coords[0, 0]
+    cy = ((y[:-1] + y[1:]) * a).sum() / (3 * area) + coords[0, 1]
+    return cx, cy
+
+
+def polygon_label(polygon, tolerance=LABEL_PRECISION):
+    """
+    Finds label position of polygon: centroid for convex polygons, otherwise pole of inaccessibility,
+    the latter uses the same algorithm as Shapely polylabel but evaluates cells in batches with numpy
+    """
+    centroid = _convex_centroid(polygon)
+    if centroid is not None:
+        return geometry.Point(centroid)
+
+    starts, ends = _ring_segments(polygon)
+    minx, miny, maxx, maxy = polygon.bounds
+    width = maxx - minx
+    height = maxy - miny
+    cell_size = min(width, height)
+    if cell_size == 0:
+        return geometry.Point(minx, miny)
+    h = cell_size / 2.0
+
+    # first best approximations are polygon centroid and bounding box center
+    c = polygon.centroid
+    xs = numpy.array([c.x, minx + width / 2.0])
+    ys = numpy.array([c.y, miny + height / 2.0])
+    distances = _signed_distances(xs, ys, starts, ends)
+    best = 1 if distances[1] > distances[0] else 0
+    best_x, best_y, best_distance = xs[best], ys[best], distances[best]
+
+    # regular square grid covering the polygon, cells are refined level by level so that all cells
+    # of a level are evaluated at once, cells which can not contain better solution are dropped
+    xs, ys = numpy.meshgrid(numpy.arange(minx, maxx, cell_size) + h, numpy.arange(miny, maxy, cell_size) + h)
+    xs = xs.ravel()
+    ys = ys.ravel()
+    while len(xs):
+        distances = _signed_distances(xs, ys, starts, ends)
+        best = numpy.argmax(distances)
+        if distances[best] > best_distance:
+            best_x, best_y, best_distance = xs[best], ys[best], distances[best]
+        keep = distances + h * 1.4142135623730951 - best_distance > tolerance
+        xs = xs[keep]
+        ys = ys[keep]
+        # split the cells into quadrants
+        h /= 2.0
+        xs = numpy.concatenate((xs - h, xs + h, xs - h, xs + h))
+        ys = numpy.concatenate((ys - h, ys - h, ys + h, ys + h))
+    return geometry.Point(best_x, best_y)
+
+
+def polylabel(geom, label=None):
+    """
+    Returns label of polygon or labels of multipolygon parts, the largest part first, and area of polygon
+    or its largest part. Label found earlier for the same geometry can be passed to skip search.
+    """
     area = 0
     if geom.type == 'Polygon':
         area = geom.area
-        label = shapely_polylabel(geom, 1.194)  # pixel width at zoom 17
+        if label is None:
+            label = polygon_label(geom)
     elif geom.type == 'MultiPolygon':
+        if label is not None:
+            return label, max(p.area for p in geom.geoms)
         label = []
-        for p in geom:
-            lbl = shapely_polylabel(p, 1.194)
+        for p in geom.geoms:
+            lbl = polygon_label(p)
             if p.area > area:  # we need to find largest polygon for main label
                 area = p.area
                 label.insert(0, lbl)
             else:
                 label.append(lbl)
+    else:
+        label = None
     return label, area
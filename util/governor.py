@@ -0,0 +1,111 @@
+import threading
+import multiprocessing
+
+import psutil
+
+
+class MemoryGovernor:
+    """
+    Controls number of tile worker processes by their actual memory consumption. Worker cost is the
+    peak of its unique memory (shared element store and pages inherited from parent are not accounted),
+    workers are added while available memory can accommodate them and retired when it drops below
+    reserve. When memory is low tile dispatch is paused first to let transient consumers finish.
+    """
+    def __init__(self, start_worker, max_workers, logger, initial=2, reserve=0.1, interval=2.0, warmup=10.0):
+        self.start_worker = start_worker  # callable(index) returning started process
+        self.max_workers = max_workers
+        self.logger = logger
+        self.initial = max(1, min(initial, max_workers))
+        self.reserve = int(psutil.virtual_memory().total * reserve)
+        self.interval = interval
+        self.warmup = warmup  # seconds to measure worker cost before adding workers
+        self.active = multiprocessing.Value('i', 0)  # workers with lower index are allowed to run
+        self.dispatch = multiprocessing.Event()
+        self.dispatch.set()
+        self.processes = {}  # index -> process
+        self.worker_cost = 0
+        self.peak_workers = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def admit(self, index):
+        """
+        called by worker before taking next tile, blocks while dispatch is paused,
+        returns False if worker should exit
+        """
+        while not self.dispatch.wait(1.0):
+            if index >= self.active.value:
+                return False
+        return index < self.active.value
+
+    def start(self):
+        self.active.value = self.initial
+        self.spawn()
+        self.thread = threading.Thread(target=self.run, name="memory governor")
+        self.thread.start()
+
+    def stop(self):
+        """
+        stops governing, returns running worker processes
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.dispatch.set()
+        self.logger.info("    peak {} workers, worker cost {:,}M".format(self.peak_workers, self.worker_cost // 1048576))
+        return list(self.processes.values())
+
+    def workers(self):
+        return list(self.processes.values())
+
+    def spawn(self):
+        for index, p in list(self.processes.items()):
+            if not p.is_alive():
+                p.join()
+                del self.processes[index]
+        for index in range(self.active.value):
+            if index not in self.processes:
+                self.processes[index] = self.start_worker(index)
+        self.peak_workers = max(self.peak_workers, len(self.processes))
+
+    def measure(self):
+        for p in self.processes.values():
+            try:
+                self.worker_cost = max(self.worker_cost, psutil.Process(p.pid).memory_full_info().uss)
+            except psutil.Error:
+                pass  # worker has just exited
+
+    def run(self):
+        elapsed = 0.0
+        while not self.stopped.wait(self.interval):
+            elapsed += self.interval
+            self.measure()
+            self.update(psutil.virtual_memory().available, elapsed >= self.warmup)
+            self.spawn()
+
+    def update(self, available, warm):
+        active = self.active.value
+        if available < self.reserve and active > 1:
+            if self.dispatch.is_set():
+                self.dispatch.clear()
+                self.logger.warning("    available memory {:,}M is below {:,}M, pausing tile dispatch".format(
+                    available // 1048576, self.reserve // 1048576))
+            else:
+                self.active.value = active - 1
+                self.logger.warning("    available memory {:,}M is still low, reducing workers to {}".format(
+                    available // 1048576, active - 1))
+            return
+        if not self.dispatch.is_set():
+            self.dispatch.set()
+            if available < self.reserve:
+                self.logger.warning("    available memory {:,}M is low, continuing with single worker".format(available // 1048576))
+            else:
+                self.logger.info("    available memory {:,}M, resuming tile dispatch".format(available // 1048576))
+            return
+        if not warm or not self.worker_cost or active >= self.max_workers:
+            return
+        # grow gradually as worker cost estimate may be not settled yet
+        extra = min((available - self.reserve) // self.worker_cost, self.max_workers - active, active)
+        if extra > 0:
+            self.active.value = active + extra
+            self.logger.info("    worker cost {:,}M, available memory {:,}M, increasing workers to {}".format(
+                self.worker_cost // 1048576, available // 1048576, active + extra))
@@ -0,0 +1,115 @@
+import struct
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_HEADER_SIZE = 19  # signature, flags and header extension length
+
+_int16 = struct.Struct('!h')
+_int32 = struct.Struct('!i')
+_int64 = struct.Struct('!q')
+
+
+def decode_bytea(data):
+    return bytes(data)
+
+
+def decode_int8(data):
+    return _int64.unpack_from(data)[0]
+
+
+def decode_hstore(data):
+    """
+    Decodes hstore binary representation: pair count followed by length prefixed keys and values
+    """
+    count = _int32.unpack_from(data, 0)[0]
+    position = 4
+    result = {}
+    for _ in range(count):
+        length = _int32.unpack_from(data, position)[0]
+        position += 4
+        key = str(data[position:position + length], 'utf-8')
+        position += length
+        length = _int32.unpack_from(data, position)[0]
+        position += 4
+        if length < 0:
+            value = None
+        else:
+            value = str(data[position:position + length], 'utf-8')
+            position += length
+        result[key] = value
+    return result
+
+
+class BinaryCopyParser:
+    """
+    Parses PostgreSQL binary COPY stream. It is used as file object for cursor.copy_expert() so that
+    rows are decoded and passed to callback as they arrive instead of being buffered. Each field is
+    decoded by corresponding decoder, NULL fields are passed as None.
+    """
+    def __init__(self, decoders, callback):
+        self.decoders = decoders
+        self.callback = callback
+        self.buffer = bytearray()
+        self.header = False
+        self.finished = False
+        self.count = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.parse()
+        return len(data)
+
+    def rowEnd(self, buffer, offset, fields):
+        """
+        returns position after row starting at offset or -1 if row is not received completely
+        """
+        size = len(buffer)
+        position = offset + 2
+        for _ in range(fields):
+            if position + 4 > size:
+                return -1
+            length = _int32.unpack_from(buffer, position)[0]
+            position += 4
+            if length > 0:
+                position += length
+        return position if position <= size else -1
+
+    def parse(self):
+        buffer = self.buffer
+        offset = 0
+        if not self.header:
+            if len(buffer) < COPY_HEADER_SIZE:
+                return
+            if buffer[:len(COPY_SIGNATURE)] != COPY_SIGNATURE:
+                raise ValueError("Invalid binary COPY signature")
+            extension = _int32.unpack_from(buffer, COPY_HEADER_SIZE - 4)[0]
+            if len(buffer) < COPY_HEADER_SIZE + extension:
+                return
+            offset = COPY_HEADER_SIZE + extension
+            self.header = True
+        # view is released before buffer is resized
+        with memoryview(buffer) as view:
+            while not self.finished and offset + 2 <= len(buffer):
+                fields = _int16.unpack_from(buffer, offset)[0]
+                if fields == -1:
+                    self.finished = True
+                    offset += 2
+                    break
+                if fields != len(self.decoders):
+                    raise ValueError("Unexpected number of fields in COPY row: %d" % fields)
+                end = self.rowEnd(buffer, offset, fields)
+                if end < 0:
+                    break
+                position = offset + 2
+                row = []
+                for decoder in self.decoders:
+                    length = _int32.unpack_from(buffer, position)[0]
+                    position += 4
+                    if length < 0:
+                        row.append(None)
+                    else:
+                        row.append(decoder(view[position:position + length]))
+                        position += length
+                offset = end
+                self.count += 1
+                self.callback(row)
+        del buffer[:offset]
@@ -2,9 +2,11 @@ import logging
 from tqdm import tqdm
 from shapely.geometry import CAP_STYLE
 from shapely.prepared import prep
+from shapely.ops import unary_union
 from shapely.errors import ShapelyError
 
 from util.core import Element
+from util.geometry import GeometryIndex
 
 
 BUFFER_RESOLUTION = 3
@@ -28,16 +30,17 @@ def process(elements, interactive):
     else:
         logging.info("      subtract %d bridges from %d rivers", len(bridges), len(rivers))
 
+    index = GeometryIndex(bridges)
     for river in rivers:
         prepared_river = prep(river.geom)
-        for bridge in bridges:
+        candidates = [bridges[i] for i in index.query(river.geom)]
+        hits = [bridge for bridge in candidates if prepared_river.intersects(bridge)]
+        if hits:
             try:
-                if prepared_river.intersects(bridge):
-                    geom = river.geom.intersection(bridge)
-                    if not geom.is_empty:
-                        river.geom = river.geom.difference(bridge)
+                # subtract all bridges crossing river at once
+                river.geom = river.geom.difference(unary_union(hits))
             except ShapelyError:
-                logging.error("        failed to cut bridge %s from %s", bridge.osm_id(), river.osm_id())
+                logging.error("        failed to cut bridges from %s", river.osm_id())
         if river.geom.is_empty:
             logging.debug("        cutting produced empty geom for %s", river.osm_id())
             drop_elements.append(river)
@@ -49,5 +52,6 @@ def process(elements, interactive):
         progress.close()
 
     # remove empty rivers (almost likely culverts)
-    for element in drop_elements:
-        elements.remove(element)
+    if drop_elements:
+        drop_ids = set(id(element) for element in drop_elements)
+        elements[:] = [element for element in elements if id(element) not in drop_ids]
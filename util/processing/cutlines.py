@@ -2,9 +2,11 @@ import logging
 from tqdm import tqdm
 from shapely.geometry import CAP_STYLE
 from shapely.prepared import prep
+from shapely.ops import unary_union
 from shapely.errors import ShapelyError
 
 from util.core import Element
+from util.geometry import GeometryIndex
 
 
 BUFFER_RESOLUTION = 3
@@ -23,8 +25,9 @@ def process(elements, interactive):
             woods.append(element)
 
     # remove cut lines that are nothing else
-    for element in cutlines:
-        elements.remove(element)
+    if cutlines:
+        cutline_ids = set(id(element) for element in cutlines)
+        elements[:] = [element for element in elements if id(element) not in cutline_ids]
 
     if not woods or not cutline_areas:
         return
@@ -34,16 +37,21 @@ def process(elements, interactive):
     else:
         logging.info("      subtract %d cut lines from %d woods", len(cutline_areas), len(woods))
 
+    index = GeometryIndex(cutline_areas)
     for wood in woods:
         prepared_wood = prep(wood.geom)
-        for cutline in cutline_areas:
+        candidates = [cutline_areas[i] for i in index.query(wood.geom)]
+        hits = [cutline for cutline in candidates if prepared_wood.intersects(cutline)]
+        if hits:
             try:
-                if prepared_wood.intersects(cutline):
-                    geom = wood.geom.intersection(cutline)
-                    if not geom.is_empty:
-                        wood.geom = wood.geom.difference(cutline)
-                        # this is not always true but makes map more readable
-                        elements.append(Element(None, geom, {'natural': 'grassland'}, {'zoom-min': 14}))
+                # cut all lines crossing wood at once
+                cutline = unary_union(hits)
+                geom = wood.geom.intersection(cutline)
+                if not geom.is_empty:
+                    wood.geom = wood.geom.difference(cutline)
+                    # this is not always true but makes map more readable, each cut keeps its own element
+                    for part in getattr(geom, 'geoms', [geom]):
+                        elements.append(Element(None, part, {'natural': 'grassland'}, {'zoom-min': 14}))
             except ShapelyError:
                 logging.error("   failed to cut lines from %s", wood.osm_id())
         if wood.geom.is_empty:
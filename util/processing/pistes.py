@@ -10,7 +10,7 @@ from shapely.prepared import prep
 from tqdm import tqdm
 
 from util.core import Element
-from util.geometry import mercator_to_wgs84
+from util.projection import mercator_to_wgs84
 
 
 BUFFER_RESOLUTION = 3
@@ -0,0 +1,86 @@
+import json
+import time
+from collections import OrderedDict
+
+
+class Timer:
+    """
+    Context manager adding elapsed time of the block to profile counter
+    """
+    __slots__ = ('profile', 'zoom', 'operation', 'count', 'start')
+
+    def __init__(self, profile, zoom, operation, count):
+        self.profile = profile
+        self.zoom = zoom
+        self.operation = operation
+        self.count = count
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.add(self.zoom, self.operation, time.perf_counter() - self.start, self.count)
+
+
+class StageTimer:
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.add_stage(self.name, time.perf_counter() - self.start)
+
+
+class Profile:
+    """
+    Collects wall time of map creation stages and per zoom counters of tile operations. Counters
+    are plain dictionary so that they can be passed from worker processes and merged.
+    """
+    def __init__(self):
+        self.stages = OrderedDict()  # stage -> seconds
+        self.operations = {}  # (zoom, operation) -> [count, seconds]
+
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def add_stage(self, name, elapsed):
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def measure(self, zoom, operation, count=1):
+        return Timer(self, zoom, operation, count)
+
+    def add(self, zoom, operation, elapsed, count=1):
+        counter = self.operations.get((zoom, operation), None)
+        if counter is None:
+            self.operations[(zoom, operation)] = [count, elapsed]
+        else:
+            counter[0] += count
+            counter[1] += elapsed
+
+    def merge(self, operations):
+        for (zoom, operation), (count, elapsed) in operations.items():
+            self.add(zoom, operation, elapsed, count)
+
+    def summary(self):
+        zooms = OrderedDict()
+        for (zoom, operation), (count, elapsed) in sorted(self.operations.items()):
+            zooms.setdefault(str(zoom), OrderedDict())[operation] = {'count': count, 'time': round(elapsed, 3)}
+        return {
+            'stages': OrderedDict((name, round(elapsed, 3)) for name, elapsed in self.stages.items()),
+            'zooms': zooms
+        }
+
+    def save(self, path, **extra):
+        summary = self.summary()
+        summary.update(extra)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,91 @@
+import math
+
+import numpy
+from shapely import geometry
+
+# EPSG:3857 is spherical Mercator, so it is computed in closed form on whole coordinate arrays
+EARTH_RADIUS = 6378137.0
+
+
+def wgs84_to_mercator(x, y, z=None):
+    """
+    Projects longitudes and latitudes (scalars or arrays) to EPSG:3857, can be used with shapely.ops.transform
+    """
+    mx = numpy.radians(x) * EARTH_RADIUS
+    my = numpy.log(numpy.tan(numpy.radians(y) / 2 + math.pi / 4)) * EARTH_RADIUS
+    return (mx, my) if z is None else (mx, my, z)
+
+
+def mercator_to_wgs84(x, y, z=None):
+    """
+    Unprojects EPSG:3857 coordinates (scalars or arrays) to longitudes and latitudes
+    """
+    lon = numpy.degrees(numpy.asarray(x) / EARTH_RADIUS)
+    lat = numpy.degrees(2 * numpy.arctan(numpy.exp(numpy.asarray(y) / EARTH_RADIUS)) - math.pi / 2)
+    return (lon, lat) if z is None else (lon, lat, z)
+
+
+def _sequences(geom):
+    if geom.is_empty:
+        return []
+    geom_type = geom.geom_type
+    if geom_type in ('Point', 'LineString', 'LinearRing'):
+        return [geom.coords]
+    if geom_type == 'Polygon':
+        return [geom.exterior.coords] + [interior.coords for interior in geom.interiors]
+    return [sequence for part in geom.geoms for sequence in _sequences(part)]
+
+
+def _rebuild(geom, sequences):
+    if geom.is_empty:
+        return geom
+    geom_type = geom.geom_type
+    if geom_type == 'Point':
+        return geometry.Point(next(sequences)[0])
+    if geom_type == 'LineString':
+        return geometry.LineString(next(sequences))
+    if geom_type == 'LinearRing':
+        return geometry.LinearRing(next(sequences))
+    if geom_type == 'Polygon':
+        shell = next(sequences)
+        return geometry.Polygon(shell, [next(sequences) for _ in geom.interiors])
+    return type(geom)([_rebuild(part, sequences) for part in geom.geoms])
+
+
+def transform_geometries(project, geoms):
+    """
+    Transforms list of geometries with single call of project(xs, ys) on all their coordinates
+    """
+    sequences = [numpy.asarray(sequence)[:, :2] for geom in geoms for sequence in _sequences(geom)]
+    if not sequences:
+        return list(geoms)
+    coords = numpy.concatenate(sequences)
+    xs, ys = project(coords[:, 0], coords[:, 1])
+    projected = numpy.column_stack((xs, ys))
+    splits = numpy.cumsum([len(sequence) for sequence in sequences])[:-1]
+    parts = iter(numpy.split(projected, splits))
+    return [_rebuild(geom, parts) for geom in geoms]
+
+
+def geometries_to_mercator(geoms):
+    return transform_geometries(wgs84_to_mercator, geoms)
+
+
+def geometry_to_mercator(geom):
+    return transform_geometries(wgs84_to_mercator, [geom])[0]
+
+
+def points_to_wgs84(points):
+    """
+    Returns arrays of longitudes and latitudes of EPSG:3857 points
+    """
+    coords = numpy.array([(point.x, point.y) for point in points], dtype=numpy.float64).reshape(-1, 2)
+    return mercator_to_wgs84(coords[:, 0], coords[:, 1])
+
+
+def point_to_wgs84(point):
+    """
+    Returns longitude and latitude of EPSG:3857 point
+    """
+    lon, lat = mercator_to_wgs84(point.x, point.y)
+    return float(lon), float(lat)
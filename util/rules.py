@@ -0,0 +1,105 @@
+from collections import namedtuple
+
+
+# mapping parameters that are copied to element mapping as is
+PLAIN_PARAMETERS = ('filter-area', 'buffer', 'enlarge', 'simplify', 'force-line', 'label', 'filter-type',
+                    'clip-buffer', 'keep-tags', 'basemap-label', 'basemap-keep-tags', 'basemap-filter-area')
+
+Rewrite = namedtuple('Rewrite', ['key', 'value', 'if_missing', 'add_tags', 'keep_for', 'zoom_min', 'render'])
+Entry = namedtuple('Entry', ['one_of', 'adjust', 'render', 'ignore', 'keep_for', 'plain', 'union', 'transform',
+                             'transform_exclusive', 'union_zoom_max', 'zoom_min', 'zoom_max', 'modifier',
+                             'processor'])
+Rule = namedtuple('Rule', ['rewrite', 'entry'])
+
+
+def _compile_entry(m):
+    render = m.get('render', True)
+    return Entry(
+        frozenset(m['one-of']) if 'one-of' in m else None,
+        m.get('adjust', None),
+        render,
+        m.get('ignore', not render),
+        m.get('keep-for', None),
+        {k: m[k] for k in PLAIN_PARAMETERS if k in m},
+        m.get('union', None),
+        m.get('transform', None),
+        m.get('transform-exclusive', False),
+        m.get('union-zoom-max', None),
+        m.get('zoom-min', None),
+        m.get('zoom-max', None),
+        m.get('modify-mapping', None),
+        m.get('pre-process', None)
+    )
+
+
+EMPTY_ENTRY = _compile_entry({})
+
+
+class RuleTable:
+    """
+    Flat representation of tag mappings compiled once so that tag filter does not have to
+    interpret nested mapping dictionaries for every tag of every element.
+    """
+    def __init__(self, tags):
+        self.tags = tags
+        self.entries = {}  # compiled entries shared by identity of source mapping dictionaries
+        self.rules = {}  # key -> (rule for __any__, {value: rule})
+        for key, values in tags.items():
+            any_rule = None
+            if isinstance(values.get('__any__', None), dict):
+                any_rule = self._compile_rule(key, values['__any__'])
+            value_rules = {}
+            for value, m in values.items():
+                if value != '__any__' and isinstance(m, dict):
+                    value_rules[value] = self._compile_rule(key, m)
+            self.rules[key] = (any_rule, value_rules)
+
+    def _entry(self, m):
+        entry = self.entries.get(id(m), None)
+        if entry is None:
+            entry = _compile_entry(m)
+            self.entries[id(m)] = (entry, m)  # keep reference to source to preserve its identity
+            return entry
+        return entry[0]
+
+    def _compile_rule(self, key, m):
+        if 'rewrite-key' not in m and 'rewrite-value' not in m:
+            return Rule(None, self._entry(m))
+        rewrite_key = m.get('rewrite-key', None)
+        rewrite = Rewrite(
+            rewrite_key or key,
+            m.get('rewrite-value', None),
+            m.get('rewrite-if-missing', False),
+            m['add-tags'] if 'add-tags' in m and rewrite_key else None,
+            m['keep-for'] if 'keep-for' in m and rewrite_key else None,
+            m.get('zoom-min', None),
+            m.get('render', False)
+        )
+        # target mapping can be resolved in advance only if value is rewritten
+        entry = None
+        if 'rewrite-value' in m:
+            entry = self.target(rewrite.key, m['rewrite-value'])
+        return Rule(rewrite, entry)
+
+    def get(self, key, value):
+        """
+        Returns rule for the tag or None if tag is not mapped
+        """
+        rules = self.rules.get(key, None)
+        if rules is None:
+            return None
+        if rules[0] is not None:
+            return rules[0]
+        return rules[1].get(value, None)
+
+    def target(self, key, value):
+        """
+        Returns mapping entry for rewritten tag
+        """
+        values = self.tags[key]
+        m = values.get(value, None)
+        if m is None:
+            m = values.get('__any__', None)
+            if m is None:
+                return EMPTY_ENTRY
+        return self._entry(m)
@@ -0,0 +1,105 @@
+import gzip
+import mmap
+import pickle
+import tempfile
+from array import array
+from collections import namedtuple
+
+import shapely.wkb as shapely_wkb
+
+from util.core import Element
+from util.fingerprint import element_digest
+
+
+TileJob = namedtuple('TileJob', ['zoom', 'x', 'y', 'indices', 'clipped'])
+
+
+class ElementStore:
+    """
+    Read-only storage of map elements shared by tile worker processes. Geometries are kept as WKB
+    in memory mapped file, other properties in compact tables. Workers inherit it on fork, so tile
+    jobs need to carry only element indices and geometries of clipped elements.
+    """
+    def __init__(self, elements, directory=None, digests=False):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.offsets = array('q', [0])
+        self.ids = []
+        self.tags = []
+        self.mappings = []
+        self.mapping_index = array('l')
+        self.attributes = []
+        self.digests = [] if digests else None
+        mapping_refs = {}
+        offset = 0
+        for index, element in enumerate(elements):
+            wkb = element.geom.wkb
+            self.file.write(wkb)
+            offset += len(wkb)
+            self.offsets.append(offset)
+            self.ids.append(element.id)
+            self.tags.append(element.tags)
+            ref = mapping_refs.get(id(element.mapping), None)
+            if ref is None:
+                ref = len(self.mappings)
+                mapping_refs[id(element.mapping)] = ref
+                self.mappings.append(element.mapping)
+            self.mapping_index.append(ref)
+            self.attributes.append(element.attributes)
+            if digests:
+                self.digests.append(element_digest(element, wkb))
+            element.index = index
+        self.file.flush()
+        self.arena = mmap.mmap(self.file.fileno(), offset, access=mmap.ACCESS_READ) if offset else b''
+
+    def __len__(self):
+        return len(self.ids)
+
+    def wkb(self, index):
+        return self.arena[self.offsets[index]:self.offsets[index + 1]]
+
+    def element(self, index, wkb=None):
+        """
+        Returns element restored from the store, wkb overrides stored geometry (used for clipped elements)
+        """
+        geom = shapely_wkb.loads(wkb if wkb is not None else self.wkb(index))
+        # tags are modified in tile processing, so each tile gets its own copy
+        el = Element(self.ids[index], geom, dict(self.tags[index]), self.mappings[self.mapping_index[index]])
+        el.label, el.area, el.kind, el.type, el.building = self.attributes[index]
+        el.index = index
+        if self.digests is not None:
+            if wkb is None:
+                el.digest = self.digests[index]
+            else:
+                element_digest(el, wkb)
+        return el
+
+    def elements(self, job):
+        return [self.element(index, job.clipped.get(index, None)) for index in job.indices]
+
+    @staticmethod
+    def job(tile):
+        # clipped geometries are serialized only here, tiles generated locally keep them as they are
+        clipped = {el.index: el.geom.wkb for el in tile.elements if el.index in tile.clipped}
+        return TileJob(tile.zoom, tile.x, tile.y, array('l', [el.index for el in tile.elements]), clipped)
+
+    def close(self):
+        if isinstance(self.arena, mmap.mmap):
+            self.arena.close()
+        self.file.close()
+
+
+def dump_elements(path, zoom, x, y, elements):
+    """
+    Saves processed elements of an area for later reproducible tile generation
+    """
+    with gzip.open(path, 'wb') as f:
+        pickle.dump({'zoom': zoom, 'x': x, 'y': y, 'elements': elements}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_elements(path):
+    """
+    Returns zoom, x, y and elements of a saved area
+    """
+    with gzip.open(path, 'rb') as f:
+        data = pickle.load(f)
+    return data['zoom'], data['x'], data['y'], data['elements']